@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Check that the catalog picks up clips added by another process.
+
+Interleaves clips imported through a second database connection with clips
+added through the catalog, like an import running next to the bot, and
+checks that `Catalog.refresh` finds every imported clip and its url aliases:
+
+    $ python3 bench/catalog_refresh.py
+
+Runs against a database in a temporary directory and exits with 1 if any
+check fails.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+HOME = tempfile.mkdtemp(prefix="catalog-refresh-")
+os.environ["HOME"] = HOME
+os.makedirs(os.path.join(HOME, "displaybot"))
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "displaybot"))
+
+from catalog import Catalog  # noqa: E402
+from storage import Storage  # noqa: E402
+
+
+def clips(prefix, count):
+    """Return clip dicts to insert."""
+    return [{"url": "http://example.com/{}{}.mp4".format(prefix, i),
+        "filename": "{}{}".format(prefix, i)} for i in range(count)]
+
+
+def main():
+    """Run the interleavings and report failed checks."""
+    path = os.path.join(HOME, "displaybot", "refresh.db")
+    bot_db = Storage(path)
+    bot_db.create()
+    importer_db = Storage(path)
+    catalog = Catalog(bot_db)
+    catalog.load()
+    failed = []
+
+    def check(name, found, expected):
+        print("{}: refresh found {} of {}, catalog {} clips, database {}".format(
+            name, found, expected, len(catalog), bot_db.count_clips()))
+        if found != expected or len(catalog) != bot_db.count_clips():
+            failed.append(name)
+
+    # An import batch is committed, then the bot ingests a clip of its own
+    importer_db.insert_clips(clips("import", 3))
+    catalog.add(clips("bot", 1)[0])
+    check("import before bot clip", len(catalog.refresh()), 3)
+
+    # The bot ingests a clip between two import batches
+    importer_db.insert_clips(clips("batch", 2))
+    catalog.add(clips("bot", 2)[1])
+    importer_db.insert_clips(clips("later", 2))
+    check("bot clip between batches", len(catalog.refresh()), 4)
+
+    # Url aliases of imported clips
+    clip_id = importer_db.insert_clip(clips("aliased", 1)[0])
+    importer_db.insert_clip_url("http://example.com/alias.mp4", clip_id)
+    check("aliased clip", len(catalog.refresh()), 1)
+    alias = catalog.find("http://example.com/alias.mp4")
+    if alias is None or alias["id"] != clip_id:
+        print("alias not found")
+        failed.append("alias")
+
+    # Deleting the newest clips frees their ids for the next import
+    catalog.remove([c for c in catalog.all() if c["id"] >= clip_id - 1])
+    importer_db.insert_clips(clips("reused", 2))
+    check("reused ids", len(catalog.refresh()), 2)
+
+    shutil.rmtree(HOME)
+    for name in failed:
+        print("FAILED: {}".format(name))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
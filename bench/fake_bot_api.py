@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Local stand-in for the Telegram Bot API.
+
+Answers `sendMessage`, `sendPhoto`, `editMessageText` and friends under
+`/bot<token>/<method>` like api.telegram.org does, records every call and
+enforces flood limits: more than `chat_limit` messages to a chat in a minute
+or more than `global_limit` messages in a second are answered with `429 Too
+Many Requests` and a `retry_after`. Point a bot at it with
+
+    telegram.Bot(token, base_url="http://127.0.0.1:8081/bot")
+
+or run it standalone with
+
+    $ python3 bench/fake_bot_api.py --port 8081
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "displaybot"))
+
+from metrics import ThreadingHTTPServer  # noqa: E402
+
+
+class FakeBotAPI(object):
+    """Record Bot API calls and answer them, simulating flood limits."""
+
+    def __init__(self, port=0, chat_limit=20, global_limit=30):
+        """Create server on localhost, started with `start`."""
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.lock = threading.Lock()
+        self.calls = []
+        self.rejected = []
+        self.history = defaultdict(deque)
+        self.recent = deque()
+        self.message_id = 0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                if self.headers.get("Content-Type", "").startswith(
+                        "application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = {k: v[0] for k, v in parse_qs(body).items()}
+                method = self.path.rsplit("/", 1)[-1]
+                status, rv = api.handle(method, params)
+                data = json.dumps(rv).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.port = self.server.server_address[1]
+        self.url = "http://127.0.0.1:{}/bot".format(self.port)
+
+    def start(self):
+        """Serve in a daemon thread."""
+        t = threading.Thread(target=self.server.serve_forever, name="fake-bot-api")
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        """Shut down the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def retry_after(self, chat_id, now):
+        """Return seconds the chat has to wait or 0 if it may send now."""
+        while len(self.recent) > 0 and now - self.recent[0] > 1.0:
+            self.recent.popleft()
+        if len(self.recent) >= self.global_limit:
+            return 1
+
+        history = self.history[chat_id]
+        while len(history) > 0 and now - history[0] > 60.0:
+            history.popleft()
+        if len(history) >= self.chat_limit:
+            return int(60.0 - (now - history[0])) + 1
+        return 0
+
+    def handle(self, method, params):
+        """Return status and response body of a Bot API call."""
+        now = time.time()
+        if method == "getMe":
+            return 200, {"ok": True, "result": {
+                "id": 1, "first_name": "displaybot", "username": "displaybot"}}
+
+        chat_id = params.get("chat_id")
+        with self.lock:
+            if method in ("sendChatAction", "answerCallbackQuery"):
+                self.calls.append((now, method, chat_id, params))
+                return 200, {"ok": True, "result": True}
+
+            wait = self.retry_after(chat_id, now)
+            if wait > 0:
+                self.rejected.append((now, method, chat_id, params))
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after {}".format(wait),
+                    "parameters": {"retry_after": wait}}
+
+            self.history[chat_id].append(now)
+            self.recent.append(now)
+            self.calls.append((now, method, chat_id, params))
+            self.message_id += 1
+            return 200, {"ok": True, "result": {
+                "message_id": params.get("message_id", self.message_id),
+                "date": int(now),
+                "chat": {"id": int(chat_id), "type": "group"},
+                "text": params.get("text", "")}}
+
+
+def main():
+    """Run the fake api until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--chat-limit", type=int, default=20,
+        help="messages per chat and minute")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.port, args.chat_limit)
+    print("Serving fake Bot API at {}<token>/<method>".format(api.url))
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("{} calls, {} rejected".format(len(api.calls), len(api.rejected)))
+
+
+if __name__ == '__main__':
+    main()
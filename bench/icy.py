@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmark the ICY metadata parser on recorded radio streams.
+
+Record a few minutes of a station with
+
+    $ python3 bench/icy.py --record http://ice1.somafm.com/dronezone-128-aac dronezone.icy
+
+and benchmark the parser on recordings with
+
+    $ python3 bench/icy.py dronezone.icy fip.icy
+
+Without recordings a synthetic stream is generated. A recording is the raw
+response body of the station, preceded by a line `ICY-METAINT <n>`.
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "displaybot"))
+
+from player.icy import read_titles, parse_metadata  # noqa: E402
+from player.probe import request  # noqa: E402
+
+
+def record(url, fpath, seconds):
+    """Save the raw stream of a station for `seconds`."""
+    r = request(url, 30, metadata=True)
+    metaint = int(r.headers["icy-metaint"])
+    t0 = time.time()
+    with open(fpath, "wb") as f:
+        f.write("ICY-METAINT {}\n".format(metaint).encode("ascii"))
+        for chunk in iter(lambda: r.fp.read(64 * 1024), b""):
+            f.write(chunk)
+            if time.time() - t0 > seconds:
+                break
+    r.close()
+
+
+def load(fpath):
+    """Return metaint and stream body of a recording."""
+    with open(fpath, "rb") as f:
+        header = f.readline().decode("ascii").split()
+        return int(header[1]), f.read()
+
+
+def synthesize(metaint=16000, blocks=2000):
+    """Return metaint and body of a stream with a new title every 10 blocks."""
+    audio = b"\xff" * metaint
+    parts = []
+    for i in range(blocks):
+        parts.append(audio)
+        if i % 10 == 0:
+            meta = "StreamTitle='Artist {0} - Title {0}';StreamUrl='';".format(
+                i).encode("utf-8")
+            length = (len(meta) + 15) // 16
+            parts.append(bytes([length]) + meta.ljust(length * 16, b"\0"))
+        else:
+            parts.append(b"\0")
+    return metaint, b"".join(parts)
+
+
+def bench_stream(name, metaint, body):
+    """Time reading all titles from a stream body."""
+    t0 = time.perf_counter()
+    titles = []
+    f = io.BytesIO(body)
+    try:
+        for title in read_titles(f, metaint):
+            titles.append(title)
+    except EOFError:
+        pass
+    dt = time.perf_counter() - t0
+    print("{}: {:.1f} MB in {:.3f}s ({:.0f} MB/s), {} titles".format(
+        name, len(body) / 1e6, dt, len(body) / 1e6 / dt, len(titles)))
+
+
+def bench_parse(n=100000):
+    """Time parsing single metadata blocks."""
+    text = "StreamTitle='Daft Punk - Harder, Better, Faster, Stronger';StreamUrl='';"
+    t0 = time.perf_counter()
+    for i in range(n):
+        parse_metadata(text)
+    dt = time.perf_counter() - t0
+    print("parse_metadata: {:.2f}us per block".format(dt / n * 1e6))
+
+
+def main():
+    """Run benchmarks or record a stream."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("files", nargs="*", help="recorded streams")
+    parser.add_argument("--record", metavar="URL", help="record a station")
+    parser.add_argument("--seconds", type=float, default=120.0)
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.files[0], args.seconds)
+        return
+
+    if args.files:
+        for fpath in args.files:
+            metaint, body = load(fpath)
+            bench_stream(os.path.basename(fpath), metaint, body)
+    else:
+        metaint, body = synthesize()
+        bench_stream("synthetic", metaint, body)
+    bench_parse()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Send a burst of announcements and replies through the outbox.
+
+Simulates fast track changes in several chats plus command replies against
+the local fake Bot API and reports how many calls Telegram would have
+rejected, how many stale announcements were coalesced away and how long
+replies waited:
+
+    $ python3 bench/outbox_burst.py --chats 3 --tracks 40 --replies 10
+
+With `--direct`, messages are sent straight from the producing thread like
+before the outbox, for comparison. With `--telegram`, calls go through
+python-telegram-bot's `Bot` instead of the minimal client below.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "displaybot"))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from outbox import Outbox, AMBIENT  # noqa: E402
+
+
+class FloodError(Exception):
+    """Bot API answered 429."""
+
+    def __init__(self, retry_after):
+        """Store seconds to wait."""
+        super(FloodError, self).__init__("Retry after {}".format(retry_after))
+        self.retry_after = retry_after
+
+
+class Client(object):
+    """Minimal Bot API client, just enough for the benchmark."""
+
+    def __init__(self, url, token="TOKEN"):
+        """Talk to the api at url."""
+        self.url = "{}{}/".format(url, token)
+
+    def call(self, method, **params):
+        """POST params as json and return the result."""
+        req = Request(self.url + method, json.dumps(params).encode("utf-8"),
+            {"Content-Type": "application/json"})
+        try:
+            with urlopen(req) as r:
+                return json.loads(r.read().decode("utf-8"))["result"]
+        except HTTPError as e:
+            rv = json.loads(e.read().decode("utf-8"))
+            raise FloodError(rv["parameters"]["retry_after"])
+
+    def sendMessage(self, **params):
+        """Send a message."""
+        return self.call("sendMessage", **params)
+
+    def sendPhoto(self, **params):
+        """Send a photo."""
+        return self.call("sendPhoto", **params)
+
+
+def run(bot, api, chats, tracks, replies, interval, direct):
+    """Produce the burst and wait until the outbox is drained."""
+    outbox = Outbox()
+    queued = {}
+    errors = 0
+
+    t0 = time.time()
+    for i in range(tracks):
+        for chat_id in chats:
+            text = "▶️ Now playing Artist {} - Title {}".format(i, i)
+            queued[(chat_id, text)] = time.time()
+            if direct:
+                try:
+                    bot.sendMessage(chat_id=chat_id, text=text)
+                except Exception:
+                    errors += 1
+            else:
+                outbox.send_message(bot, chat_id, text,
+                    priority=AMBIENT, key=("title", chat_id))
+            if i < replies:
+                text = "👾 Got it, adding clip {}...".format(i)
+                queued[(chat_id, text)] = time.time()
+                if direct:
+                    try:
+                        bot.sendMessage(chat_id=chat_id, text=text)
+                    except Exception:
+                        errors += 1
+                else:
+                    outbox.send_message(bot, chat_id, text)
+        time.sleep(interval)
+
+    while not direct and len(outbox) > 0:
+        time.sleep(0.1)
+    # Let the last call finish
+    time.sleep(1.0)
+    elapsed = time.time() - t0
+
+    reply_waits = []
+    for t, method, chat_id, params in api.calls:
+        key = (int(chat_id), params.get("text"))
+        if key in queued and params["text"].startswith("👾"):
+            reply_waits.append(t - queued[key])
+
+    rv = {
+        "mode": "direct" if direct else "outbox",
+        "queued": len(queued),
+        "delivered": len(api.calls),
+        "rejected": len(api.rejected),
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "reply_wait_mean": round(sum(reply_waits) / len(reply_waits), 3)
+            if reply_waits else None,
+        "reply_wait_max": round(max(reply_waits), 3) if reply_waits else None
+    }
+    if not direct:
+        rv.update(outbox.stats())
+    return rv
+
+
+def main():
+    """Run the benchmark and print results as json."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=3)
+    parser.add_argument("--tracks", type=int, default=40,
+        help="track changes per chat")
+    parser.add_argument("--replies", type=int, default=10,
+        help="command replies per chat")
+    parser.add_argument("--interval", type=float, default=0.1,
+        help="seconds between track changes")
+    parser.add_argument("--direct", action="store_true")
+    parser.add_argument("--telegram", action="store_true")
+    args = parser.parse_args()
+
+    api = FakeBotAPI().start()
+    if args.telegram:
+        import telegram
+        bot = telegram.Bot("TOKEN", base_url=api.url)
+    else:
+        bot = Client(api.url)
+
+    chats = [-1000 - i for i in range(args.chats)]
+    result = run(bot, api, chats, args.tracks, args.replies, args.interval,
+        args.direct)
+    api.stop()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Measure how long the bot takes to import its modules.
+
+Each phase of startup is imported in a fresh interpreter with
+`python -X importtime`, in the order `displaybot.main` imports them:
+
+- `config`: settings, before anything plays
+- `video`: everything the video player needs for the first frame
+- `telegram`: the bot, ingest pipeline and radio, loaded after that
+
+Prints the total import time of each phase and the slowest modules as json:
+
+    $ python3 bench/startup.py --top 10 --out startup.json
+
+Time to first frame is logged by the bot itself ("First frame ... after
+start") and exported as the `first_frame_seconds` metric.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "displaybot")
+
+PHASES = [
+    ("config", "import config"),
+    ("video", "import config, player.video"),
+    ("telegram", "import config, player.video, telegram.ext, bot, ingest, "
+        "player.radio, player.probe")
+]
+
+
+def importtime(statement):
+    """Return cumulative import times in seconds by module, or raise."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+        cwd=SRC, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    rv = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        rv[name[1:].rstrip()] = int(cumulative) / 1e6
+    return rv
+
+
+def main():
+    """Measure all phases and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=10,
+        help="number of slowest top level imports to show per phase")
+    parser.add_argument("--out", help="also write results to this file")
+    args = parser.parse_args()
+
+    # Modules the interpreter imports by itself, e.g. site
+    baseline = set(importtime("pass"))
+
+    results = {}
+    for phase, statement in PHASES:
+        try:
+            times = importtime(statement)
+        except RuntimeError as e:
+            results[phase] = {"error": str(e)}
+            continue
+        # Top level imports have no leading spaces in their name
+        top = {k: v for k, v in times.items()
+            if not k.startswith(" ") and k not in baseline}
+        results[phase] = {
+            "seconds": sum(top.values()),
+            "slowest": sorted(top.items(), key=lambda kv: -kv[1])[:args.top]
+        }
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
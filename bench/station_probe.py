@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Check the station prober against local stub stations.
+
+Serves stations that are live, answer with a Shoutcast `ICY 200 OK` status
+line, redirect, respond slowly, fail with 500, never answer or refuse the
+connection, probes all of them in parallel like the bot does and checks the
+results and the order of the /radio keyboard:
+
+    $ python3 bench/station_probe.py --timeout 1
+
+Prints the probe results and keyboard labels and exits with 1 if any check
+fails.
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "displaybot"))
+
+from player.probe import probe_station, station_keyboard_options  # noqa: E402
+
+
+class StationHandler(StreamRequestHandler):
+    """Answer stream requests depending on the path.
+
+    `/live` and `/icy` stream audio after `delay` seconds, with an HTTP or
+    ICY status line, `/redirect` sends clients to `to`, `/status` answers
+    with `code` and `/hang` never answers.
+    """
+
+    def handle(self):
+        """Read the request and answer it."""
+        line = self.rfile.readline().decode("latin-1")
+        while self.rfile.readline().strip():
+            pass
+        parts = urlsplit(line.split()[1])
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        time.sleep(float(query.get("delay", 0)))
+
+        if parts.path == "/hang":
+            time.sleep(self.server.hang)
+            return
+        elif parts.path == "/redirect":
+            self.answer("HTTP/1.0 302 Found", Location=query["to"])
+        elif parts.path == "/status":
+            self.answer("HTTP/1.0 {} Error".format(query["code"]))
+        else:
+            status = "ICY 200 OK" if parts.path == "/icy" else "HTTP/1.0 200 OK"
+            self.answer(status, **{"Content-Type": "audio/mpeg",
+                "icy-br": query.get("br", "128")})
+            self.stream()
+
+    def answer(self, status, **headers):
+        """Send status line and headers."""
+        lines = [status] + ["{}: {}".format(k, v) for k, v in headers.items()]
+        self.wfile.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    def stream(self):
+        """Send silence until the client hangs up."""
+        try:
+            for i in range(100):
+                self.wfile.write(b"\0" * 4096)
+                time.sleep(0.01)
+        except OSError:
+            pass
+
+
+class StationServer(ThreadingTCPServer):
+    """Stub stations on localhost, each request in a thread."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, hang):
+        """Listen on a free port, `/hang` requests are held for `hang`s."""
+        ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), StationHandler)
+        self.hang = hang
+
+
+def closed_port():
+    """Return a local port nothing listens on."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def stations(base, delay):
+    """Return stub station urls by name."""
+    return {
+        "fast": base + "/live?br=128",
+        "icy": base + "/icy?br=64&delay={}".format(delay),
+        "moved": base + "/redirect?to=/live%3Fdelay%3D{}".format(2 * delay),
+        "slow": base + "/live?br=192&delay={}".format(4 * delay),
+        "error": base + "/status?code=500",
+        "hang": base + "/hang",
+        "dead": "http://127.0.0.1:{}/live".format(closed_port()),
+    }
+
+
+def check(results, options, elapsed, timeout):
+    """Return descriptions of failed checks."""
+    failed = []
+    for name in ("fast", "icy", "moved", "slow"):
+        if not results[name]["ok"]:
+            failed.append("{} should be live".format(name))
+    for name in ("error", "hang", "dead"):
+        if results[name]["ok"]:
+            failed.append("{} should be down".format(name))
+    for name, bitrate in (("fast", 128), ("icy", 64), ("slow", 192)):
+        if results[name]["bitrate"] != bitrate:
+            failed.append("{} should have bitrate {}, not {}".format(
+                name, bitrate, results[name]["bitrate"]))
+
+    order = [name for name, label in options]
+    expected = ["fast", "icy", "moved", "slow", "unprobed",
+        "dead", "error", "hang"]
+    if order != expected:
+        failed.append("keyboard order {} should be {}".format(order, expected))
+
+    # Probes run in parallel, so all of them take about one timeout
+    if elapsed > 2 * timeout + 1:
+        failed.append("probing took {:.1f}s, not in parallel".format(elapsed))
+    return failed
+
+
+def main():
+    """Probe the stub stations from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timeout", type=float, default=1.0,
+        help="probe timeout in seconds")
+    parser.add_argument("--delay", type=float, default=0.05,
+        help="seconds between the response times of the live stations")
+    args = parser.parse_args()
+
+    server = StationServer(hang=args.timeout * 3)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    base = "http://127.0.0.1:{}".format(server.server_address[1])
+    urls = stations(base, args.delay)
+
+    t0 = time.time()
+    with ThreadPoolExecutor(len(urls)) as pool:
+        results = dict(zip(urls, pool.map(
+            lambda url: probe_station(url, args.timeout), urls.values())))
+    elapsed = time.time() - t0
+    server.shutdown()
+
+    options = station_keyboard_options(list(urls) + ["unprobed"], results)
+    for name, label in options:
+        r = results.get(name)
+        if r is None or not r["ok"]:
+            print("{:10} {:>9} {:>9} {:>6}  {}".format(name, "-", "-", "-", label))
+        else:
+            print("{:10} {:7.1f}ms {:7.1f}ms {:>6}  {}".format(name,
+                r["connect"] * 1000, r["ttfb"] * 1000, r["bitrate"] or "-", label))
+    print("Probed {} stations in {:.2f}s".format(len(urls), elapsed))
+
+    failed = check(results, options, elapsed, args.timeout)
+    for message in failed:
+        print("FAILED: {}".format(message))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
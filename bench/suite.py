@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmark the catalog, ingest and player selection hot paths.
+
+For each database size a synthetic database with that many clips and a few
+dozen stations is generated in a temporary home directory. A fresh
+interpreter then times
+
+- `config.setup` and the first catalog load
+- `Video.get_next`
+- `conversion.duplicate` for known and unknown urls
+- reading and updating the radio state
+- `Radio.interact` on mplayer output, recorded with
+  `mplayer -quiet <url> > mplayer.log` or synthesized
+- `bot.receive` end to end, with clips served by a local HTTP server, a
+  stubbed bot and mocked ffmpeg, omxplayer and mplayer
+
+Only errors are logged while timing. Results are written as json:
+
+    $ python3 bench/suite.py --sizes 1000 10000 100000 --out results.json
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from http.server import BaseHTTPRequestHandler
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC = os.path.join(ROOT, "displaybot")
+
+STATIONS = 50
+
+
+#
+# Timing
+#
+
+
+def measure(func, number):
+    """Call func `number` times and return timings in microseconds."""
+    times = []
+    for i in range(number):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return {
+        "calls": number,
+        "mean_us": sum(times) / number * 1e6,
+        "min_us": times[0] * 1e6,
+        "p95_us": times[int(number * 0.95)] * 1e6,
+        "max_us": times[-1] * 1e6
+    }
+
+
+def once(func):
+    """Call func once and return the elapsed seconds."""
+    t0 = time.perf_counter()
+    func()
+    return time.perf_counter() - t0
+
+
+#
+# Mocks for external programs
+#
+
+
+def install_mocks(ffmpeg_delay=0.0):
+    """Replace ffmpy, sh and omxplayer with fakes that don't run anything."""
+    ffmpy = types.ModuleType("ffmpy")
+
+    class FFmpeg(object):
+        def __init__(self, global_options=None, inputs=None, outputs=None):
+            self.inputs = inputs or {}
+            self.outputs = outputs or {}
+
+        def run(self, stdout=None, stderr=None):
+            time.sleep(ffmpeg_delay)
+            src = list(self.inputs)[0]
+            dst = list(self.outputs)[0]
+            if dst == "pipe:1":
+                # Random tiny frames, so fingerprints don't collide
+                return os.urandom(9 * 8 * 8), b""
+            shutil.copyfile(src, dst)
+            return None, None
+
+    class FFprobe(FFmpeg):
+        def run(self, stdout=None, stderr=None):
+            return json.dumps({"streams": [
+                {"duration": "4.0", "nb_read_packets": "100"}]}).encode(), b""
+
+    ffmpy.FFmpeg = FFmpeg
+    ffmpy.FFprobe = FFprobe
+    sys.modules["ffmpy"] = ffmpy
+
+    sh = types.ModuleType("sh")
+
+    class ErrorReturnCode_1(Exception):
+        pass
+
+    def mplayer(*args, **kwargs):
+        return types.SimpleNamespace(pid=0, wait=lambda: None,
+            terminate=lambda: None)
+
+    sh.mplayer = mplayer
+    sh.ErrorReturnCode_1 = ErrorReturnCode_1
+    sys.modules["sh"] = sh
+
+    omxplayer = types.ModuleType("omxplayer")
+    omxplayer_player = types.ModuleType("omxplayer.player")
+
+    class OMXPlayer(object):
+        def __init__(self, path, args=None, **kwargs):
+            self.path = path
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: 0
+
+    omxplayer_player.OMXPlayer = OMXPlayer
+    omxplayer.player = omxplayer_player
+    sys.modules["omxplayer"] = omxplayer
+    sys.modules["omxplayer.player"] = omxplayer_player
+
+
+#
+# Synthetic data
+#
+
+
+def prepare_home(home):
+    """Create the data directory the bot expects in a home directory."""
+    data_dir = os.path.join(home, "displaybot")
+    os.makedirs(os.path.join(data_dir, "clips"), exist_ok=True)
+    with open(os.path.join(data_dir, "TELEGRAM_API_TOKEN"), "w") as f:
+        f.write("TOKEN")
+    return data_dir
+
+
+def generate(db, size):
+    """Fill a database with `size` clips and STATIONS stations."""
+    db.create()
+    created = datetime.datetime(2017, 1, 1)
+    clips = []
+    for i in range(size):
+        content_hash = hashlib.sha1(str(i).encode("ascii")).hexdigest()
+        clips.append({
+            "url": "https://media.example.com/clips/{}.mp4".format(i),
+            "author": "author{}".format(i % 20),
+            "filename": content_hash,
+            "created": (created + datetime.timedelta(minutes=i)).isoformat(),
+            "incoming": False,
+            "content_hash": content_hash,
+            "duration": 2.0 + i % 10,
+            "frames": 50 + i % 250
+        })
+    db.insert_clips(clips)
+    db.insert_radio(
+        station_playing=None,
+        station_playing_sent=None,
+        station_title=None,
+        station_title_sent=None)
+    db.insert_stations({"station {}".format(i):
+        "http://stream{}.example.com/live.mp3".format(i)
+        for i in range(STATIONS)})
+
+
+def mplayer_output(fpath=None, lines=20000):
+    """Return recorded mplayer output or synthesized lines."""
+    if fpath is not None:
+        with open(fpath, encoding="utf-8", errors="replace") as f:
+            return [line.rstrip("\n") for line in f]
+
+    rv = []
+    for i in range(lines):
+        if i % 50 == 0:
+            rv.append("ICY Info: StreamTitle='Artist {0} - Title {0}';"
+                "StreamUrl='http://example.com/{0}';".format(i))
+        elif i % 7 == 0:
+            rv.append("A:  {:.1f} (0{:.1f}) of 0.0 (unknown)  0.5% 42%".format(
+                i / 10.0, i / 10.0))
+        else:
+            rv.append("Cache fill: {:.2f}% ({} bytes)".format(i % 100, i * 1024))
+    return rv
+
+
+#
+# Ingest
+#
+
+
+class ClipHandler(BaseHTTPRequestHandler):
+    """Serve a distinct small mp4 for every path."""
+
+    size = 256 * 1024
+
+    def body(self):
+        """Return deterministic unique content for the path."""
+        seed = hashlib.sha1(self.path.encode("utf-8")).digest()
+        return seed * (self.size // len(seed))
+
+    def headers_for(self, length):
+        """Send response headers."""
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        """Answer probes."""
+        self.headers_for(len(self.body()))
+
+    def do_GET(self):
+        """Answer downloads."""
+        body = self.body()
+        self.headers_for(len(body))
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Stay quiet."""
+
+
+class StubBot(object):
+    """Count Bot API calls instead of sending them."""
+
+    def __init__(self):
+        """Start counting."""
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        """Accept any Bot API method."""
+        def call(*args, **kwargs):
+            with self.lock:
+                self.calls += 1
+        return call
+
+
+class Entity(object):
+    """Hashable message entity."""
+
+
+def update_for(url, i):
+    """Return a Telegram update with a message containing url."""
+    entity = Entity()
+    entity.offset, entity.length = 0, len(url)
+    message = types.SimpleNamespace(
+        text=url,
+        chat_id=-1000,
+        message_id=i,
+        document=None,
+        from_user=types.SimpleNamespace(first_name="bench"),
+        parse_entities=lambda types=None: {entity: url})
+    return types.SimpleNamespace(message=message)
+
+
+def bench_receive(count):
+    """Post `count` links and time until all of them are in the catalog."""
+    from bot import receive
+    from catalog import catalog
+    from ingest import pipeline
+    from metrics import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ClipHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    base = "http://127.0.0.1:{}/clip/".format(server.server_address[1])
+
+    # Remember whether the pipeline took each job
+    taken = []
+    submit = pipeline.submit
+    pipeline.submit = lambda job: taken.append(submit(job)) or taken[-1]
+
+    bot = StubBot()
+    before = len(catalog)
+    busy = 0
+    t0 = time.perf_counter()
+    for i in range(count):
+        update = update_for("{}{}.mp4".format(base, i), i)
+        receive(bot, update)
+        while not taken[-1]:
+            # Pipeline is full, try again like a user would
+            busy += 1
+            time.sleep(0.01)
+            receive(bot, update)
+    accepted = time.perf_counter() - t0
+    pipeline.join()
+    elapsed = time.perf_counter() - t0
+    server.shutdown()
+
+    added = len(catalog) - before
+    return {
+        "links": count,
+        "added": added,
+        "busy_retries": busy,
+        "accept_seconds": accepted,
+        "seconds": elapsed,
+        "clips_per_second": added / elapsed if elapsed else None
+    }
+
+
+#
+# Child process benchmarking one database
+#
+
+
+def child(args):
+    """Benchmark one database size in this interpreter."""
+    install_mocks(args.ffmpeg_delay)
+    prepare_home(os.environ["HOME"])
+    sys.path.insert(0, SRC)
+
+    from storage import Storage
+    data_dir = os.path.join(os.environ["HOME"], "displaybot")
+    t0 = time.perf_counter()
+    generate(Storage(os.path.join(data_dir, "displaybot.db")), args.child)
+    generated = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    import config
+    import_config = time.perf_counter() - t0
+    import logging
+    logging.getLogger("oxo").setLevel(logging.ERROR)
+
+    import conversion
+    from catalog import catalog
+    from player.radio import Radio
+    from player.state import radio_state
+    from player.video import Video
+
+    rv = {"clips": args.child, "generate_seconds": generated,
+        "import_config_seconds": import_config}
+    rv["setup_seconds"] = once(config.setup)
+    rv["catalog_load_seconds"] = once(catalog.load)
+
+    n = args.number
+    rv["get_next"] = measure(Video.get_next, n)
+
+    known = ["https://media.example.com/clips/{}.mp4".format(
+        random.randrange(args.child)) for i in range(n)]
+    it = iter(known)
+    rv["duplicate_hit"] = measure(lambda: conversion.duplicate(next(it)), n)
+    rv["duplicate_miss"] = measure(
+        lambda: conversion.duplicate("https://example.com/unknown.mp4"), n)
+
+    rv["radio_state_get"] = measure(
+        lambda: radio_state.get("station_playing"), n)
+    titles = iter(range(n))
+    rv["radio_state_update"] = measure(
+        lambda: radio_state.update(station_title="Title {}".format(next(titles))),
+        min(n, 1000))
+
+    lines = mplayer_output(args.mplayer_log)
+    it = iter(lines)
+    rv["radio_interact"] = measure(lambda: Radio.interact(next(it), None),
+        len(lines))
+
+    if args.receive:
+        rv["receive"] = bench_receive(args.receive)
+
+    with open(args.out, "w") as f:
+        json.dump(rv, f)
+
+
+def run_child(size, args):
+    """Run the benchmark of one database size in a fresh interpreter."""
+    home = tempfile.mkdtemp(prefix="displaybot-bench-")
+    out = os.path.join(home, "result.json")
+    cmd = [sys.executable, os.path.abspath(__file__),
+        "--child", str(size),
+        "--out", out,
+        "--number", str(args.number),
+        "--receive", str(args.receive),
+        "--ffmpeg-delay", str(args.ffmpeg_delay)]
+    if args.mplayer_log:
+        cmd += ["--mplayer-log", os.path.abspath(args.mplayer_log)]
+    env = dict(os.environ, HOME=home)
+    try:
+        subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL)
+        with open(out) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def revision():
+    """Return the git revision of the tree or None."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Benchmark all sizes and write the results."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+",
+        default=[1000, 10000, 100000])
+    parser.add_argument("--number", type=int, default=10000,
+        help="calls per timed function")
+    parser.add_argument("--receive", type=int, default=200,
+        help="links to ingest end to end, 0 to skip")
+    parser.add_argument("--ffmpeg-delay", type=float, default=0.0,
+        help="seconds each mocked ffmpeg call takes")
+    parser.add_argument("--mplayer-log", help="recorded mplayer output")
+    parser.add_argument("--out", default="bench-results.json")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args)
+        return
+
+    results = {
+        "revision": revision(),
+        "time": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "sizes": []
+    }
+    for size in args.sizes:
+        print("Benchmarking {} clips...".format(size))
+        r = run_child(size, args)
+        results["sizes"].append(r)
+        print("  setup {:.3f}s, catalog load {:.3f}s, get_next {:.1f}us, "
+            "duplicate {:.1f}us".format(r["setup_seconds"],
+                r["catalog_load_seconds"], r["get_next"]["mean_us"],
+                r["duplicate_hit"]["mean_us"]))
+        if "receive" in r:
+            print("  receive {:.1f} clips/s".format(
+                r["receive"]["clips_per_second"]))
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Wrote {}".format(args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Post recorded Telegram updates to the webhook of a bot.
+
+Start the bot with WEBHOOK_ENABLED, then replay the sample updates in
+`bench/updates` or updates saved from the Bot API:
+
+    $ python3 bench/webhook_replay.py bench/updates/start.json bench/updates/radio.json
+
+Each file holds one update or a list of updates. They are posted in order
+with the secret from the data directory, and the response status and time
+of each request is printed. Replies of the bot go to the chats in the
+updates, use ids of a test group or set TELEGRAM_BASE_URL to the fake Bot
+API in `bench/fake_bot_api.py` to see them.
+
+With `--local`, no bot needs to run. The webhook receiver and the handlers
+of the bot are started here, with a database in a temporary directory,
+talking to the fake Bot API. Commands and messages must be answered with
+`sendMessage` and station buttons with `answerCallbackQuery` and
+`editMessageText`, in the chats of the updates:
+
+    $ python3 bench/webhook_replay.py --local bench/updates/*.json
+
+Exits with 1 if a request failed or, with `--local`, a reply is missing.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from collections import Counter
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "displaybot"))
+
+# A token in the format Telegram uses, only the fake Bot API sees it
+TOKEN = "123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi"
+
+
+def load(fpaths):
+    """Return all updates in the given files."""
+    updates = []
+    for fpath in fpaths:
+        with open(fpath) as f:
+            data = json.load(f)
+        updates.extend(data if isinstance(data, list) else [data])
+    return updates
+
+
+def post(url, update):
+    """Post an update and return the response status and seconds taken."""
+    body = json.dumps(update).encode("utf-8")
+    request = Request(url, data=body,
+        headers={"Content-Type": "application/json"})
+    t0 = time.time()
+    try:
+        with urlopen(request, timeout=10) as response:
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    return status, time.time() - t0
+
+
+def expected_calls(update):
+    """Return the (method, chat id) of the Bot API calls replying to update."""
+    if "callback_query" in update:
+        chat_id = update["callback_query"]["message"]["chat"]["id"]
+        return [("answerCallbackQuery", None), ("editMessageText", chat_id)]
+    return [("sendMessage", update["message"]["chat"]["id"])]
+
+
+def start_local():
+    """Start a receiver with the handlers of the bot and a fake Bot API.
+
+    Returns the webhook url, the secret and the fake Bot API.
+    """
+    home = tempfile.mkdtemp(prefix="webhook-replay-")
+    os.environ["HOME"] = home
+    os.makedirs(os.path.join(home, "displaybot"))
+
+    from telegram.ext import Updater
+    from config import setup
+    from displaybot import add_handlers
+    from fake_bot_api import FakeBotAPI
+    from webhook import Receiver
+    setup()
+
+    api = FakeBotAPI().start()
+    updater = Updater(TOKEN, base_url=api.url)
+    add_handlers(updater.dispatcher)
+    secret = "replay"
+    receiver = Receiver(updater.dispatcher, secret, port=0)
+    receiver.start()
+    url = "http://127.0.0.1:{}".format(receiver.server.server_address[1])
+    return url, secret, api
+
+
+def missing_calls(api, updates, timeout):
+    """Wait for the replies to updates, return those that didn't arrive."""
+    expected = Counter(call for update in updates
+        for call in expected_calls(update))
+    deadline = time.time() + timeout
+    while True:
+        with api.lock:
+            calls = Counter((method, params.get("chat_id"))
+                for t, method, chat_id, params in api.calls)
+        missing = expected - Counter({(method, int(chat_id)
+            if chat_id is not None else None): n
+            for (method, chat_id), n in calls.items()})
+        if len(missing) == 0 or time.time() > deadline:
+            return missing
+        time.sleep(0.1)
+
+
+def main():
+    """Replay updates from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="json files with updates")
+    parser.add_argument("--url", help="webhook server without the secret, "
+        "http://WEBHOOK_LISTEN:WEBHOOK_PORT by default")
+    parser.add_argument("--secret", help="webhook secret, read from "
+        "the WEBHOOK_SECRET file in the data directory by default")
+    parser.add_argument("--local", action="store_true",
+        help="replay to a receiver started here and check the replies")
+    parser.add_argument("--timeout", type=float, default=10.0,
+        help="seconds to wait for replies with --local")
+    args = parser.parse_args()
+    updates = load(args.files)
+
+    if args.local:
+        base_url, secret, api = start_local()
+    else:
+        from config import DATA_DIR, WEBHOOK_LISTEN, WEBHOOK_PORT
+        base_url = args.url or "http://{}:{}".format(
+            WEBHOOK_LISTEN, WEBHOOK_PORT)
+        secret = args.secret
+        if secret is None:
+            with open(os.path.join(DATA_DIR, "WEBHOOK_SECRET")) as f:
+                secret = f.read().strip()
+    url = "{}/{}".format(base_url.rstrip("/"), secret)
+
+    failed = 0
+    for update in updates:
+        status, seconds = post(url, update)
+        print("{} {} {:.1f}ms".format(
+            update.get("update_id"), status, seconds * 1000))
+        if status != 200:
+            failed += 1
+
+    if args.local:
+        for (method, chat_id), n in missing_calls(
+                api, updates, args.timeout).items():
+            print("FAILED: {} missing {} {} call{}".format(
+                n, method, chat_id, "s" if n > 1 else ""))
+            failed += 1
+        for t, method, chat_id, params in api.calls:
+            print("{} {} {}".format(method, chat_id,
+                params.get("text", "").split("\n")[0]))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,9 @@
 """Configuration."""
 import os
 import logging
-import requests
 
-from conversion import download_clip
+from ingest import pipeline, IngestJob
+from outbox import outbox
 
 logger = logging.getLogger('oxo')
 
@@ -18,7 +18,8 @@ logger = logging.getLogger('oxo')
 
 def start(bot, update):
     """The start command is sent when the bot is started."""
-    update.message.reply_text('Gimme dat gif. Send an .mp4 link!')
+    outbox.send_message(bot, update.message.chat_id,
+        'Gimme dat gif. Send an .mp4 link!')
 
 
 def error(bot, update, error):
@@ -41,41 +42,39 @@ def receive(bot, update):
     - if `url` ends in `gifv`, that is rewritten to `mp4`
     - if `url` ends in `gif`, the gif is downloaded and converted to a local `mp4` (see code for that below)
     """
-    doc = update.message.document
-    try:
-        if doc:
-            logger.debug("Processing attachment")
-            file_data = bot.getFile(doc.file_id)
-            logger.debug("Downloading {}".format(file_data["file_path"]))
-            download_clip(file_data["file_path"], bot, update, doc["mime_type"])
-    except Exception as e:
-        logger.error(e, exc_info=True)
+    message = update.message
+    author = message.from_user.first_name
+
+    jobs = []
+    doc = message.document
+    if doc:
+        logger.debug("Processing attachment")
+        jobs.append(IngestJob(bot, message.chat_id, message.message_id, author,
+            file_id=doc.file_id, content_type=doc.mime_type))
 
     # Add all URLs in the message
-    elems = update.message.parse_entities(types=["url"])
-    for elem in elems:
+    elems = message.parse_entities(types=["url"])
+    if len(elems) > 0:
         logger.info("Processing message with {} url entities".format(len(elems)))
-        url = update.message.text[elem.offset:(elem.offset + elem.length)]
+    for elem in elems:
+        url = message.text[elem.offset:(elem.offset + elem.length)]
 
         # Rewrite gifv links extension and try that
         if url[-4:] == "gifv":
             url = url[:-4] + "mp4"
             logger.debug("Rewrite .gifv to {}".format(url))
 
-        try:
-            link = requests.head(url, allow_redirects=True)
-            logger.debug(link)
-
-        except requests.exceptions.RequestException:
-            logger.warning("Link not valid")
-            update.message.reply_text("Link not valid")
-
-        else:
-            if "Content-Type" in link.headers:
-                download_clip(
-                    url=url,
-                    bot=bot,
-                    update=update,
-                    content_type=link.headers["Content-Type"])
-            else:
-                logger.info("Link not supported: {}".format(link.headers))
+        jobs.append(IngestJob(bot, message.chat_id, message.message_id, author,
+            url=url))
+
+    # Downloads happen in the ingest pipeline, only acknowledge here
+    accepted = [job for job in jobs if pipeline.submit(job)]
+    if len(accepted) > 0:
+        outbox.send_message(bot, message.chat_id,
+            "👾 Got it, adding {} clip{}...".format(
+                len(accepted), "s" if len(accepted) > 1 else ""),
+            reply_to_message_id=message.message_id)
+    if len(accepted) < len(jobs):
+        outbox.send_message(bot, message.chat_id,
+            "👾 Busy or already adding that. Try again later.",
+            reply_to_message_id=message.message_id)
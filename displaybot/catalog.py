@@ -0,0 +1,218 @@
+# coding: utf-8
+
+"""In-memory clip catalog."""
+
+import logging
+import os
+import time
+
+from collections import deque
+from random import randrange
+from threading import RLock
+
+import metrics
+from config import db, DATA_DIR
+
+logger = logging.getLogger('oxo')
+
+
+class Catalog(object):
+    """Clips indexed in memory and kept in sync with the database.
+
+    All clips live in a list for constant time random selection. Clips are
+    additionally indexed by id, by url, including url aliases, and by content
+    hash. Incoming clips wait in a fifo queue. The database is read once, on
+    first access, and then only for clips added by other processes with
+    `refresh`. Writes go through the catalog so that the indexes stay
+    consistent with the database.
+    """
+
+    def __init__(self, db):
+        """Create an empty catalog for the given storage."""
+        self.db = db
+        self.lock = RLock()
+        self.loaded = False
+        self.clips = []
+        self.ids = {}
+        self.urls = {}
+        self.hashes = {}
+        self.incoming = deque()
+        self.refreshed_id = 0
+
+    def __len__(self):
+        """Number of clips in the catalog."""
+        self.load()
+        return len(self.clips)
+
+    def load(self, force=False):
+        """Read all clips from the database and build the indexes."""
+        with self.lock:
+            if self.loaded and not force:
+                return
+            self.clips = []
+            self.ids = {}
+            self.urls = {}
+            self.hashes = {}
+            self.incoming = deque()
+
+            for clip in self.db.clips():
+                self._index(clip)
+            self.refreshed_id = max(self.ids, default=0)
+            for url, clip_id in self.db.clip_urls():
+                if clip_id in self.ids:
+                    self.urls[url] = self.ids[clip_id]
+            self.loaded = True
+            logger.debug("Catalog loaded with {} clips ({} incoming)".format(
+                len(self.clips), len(self.incoming)))
+
+    def refresh(self):
+        """Index clips that other processes added to the database.
+
+        Reads the clips after the highest id seen by the last load or refresh.
+        Clips added through this catalog meanwhile are already indexed, they
+        may have higher ids than clips other processes added before them.
+        Returns the new clips.
+        """
+        with self.lock:
+            if not self.loaded:
+                self.load()
+                return []
+            refreshed_id = self.refreshed_id
+            rows = self.db.clips(after=refreshed_id)
+            clips = [c for c in rows if c["id"] not in self.ids]
+            for clip in clips:
+                self._index(clip)
+            for url, clip_id in self.db.clip_urls(after=refreshed_id):
+                if clip_id in self.ids:
+                    self.urls.setdefault(url, self.ids[clip_id])
+            if len(rows) > 0:
+                self.refreshed_id = rows[-1]["id"]
+            return clips
+
+    def _index(self, clip):
+        """Add a clip document to the in-memory indexes."""
+        self.clips.append(clip)
+        self.ids[clip["id"]] = clip
+        if clip.get("url"):
+            self.urls[clip["url"]] = clip
+        if clip.get("content_hash"):
+            self.hashes[clip["content_hash"]] = clip
+        if clip.get("incoming"):
+            self.incoming.append(clip)
+
+    def add(self, clip):
+        """Insert a new clip into the database and the indexes and return it."""
+        clip = dict(clip)
+        with self.lock:
+            self.load()
+            clip["id"] = self.db.insert_clip(clip)
+            self._index(clip)
+        return clip
+
+    def add_many(self, clips):
+        """Insert new clips in one transaction and return them."""
+        clips = [dict(clip) for clip in clips]
+        with self.lock:
+            self.load()
+            for clip, clip_id in zip(clips, self.db.insert_clips(clips)):
+                clip["id"] = clip_id
+                self._index(clip)
+        return clips
+
+    def get(self, clip_id):
+        """Return the clip with the given id or None."""
+        with self.lock:
+            self.load()
+            return self.ids.get(clip_id)
+
+    def all(self):
+        """Return a list of all clips."""
+        with self.lock:
+            self.load()
+            return list(self.clips)
+
+    def update(self, clip, **fields):
+        """Change fields of a clip in the database and in memory."""
+        with self.lock:
+            self.db.update_clip(clip["id"], **fields)
+            clip.update(fields)
+
+    def played(self, clip):
+        """Record that a clip was shown."""
+        self.update(clip, last_played=time.time(),
+            play_count=(clip.get("play_count") or 0) + 1)
+
+    def remove(self, clips):
+        """Delete clips from the database and the indexes.
+
+        Rebuilds the clip list, so remove clips in bulk rather than one by one.
+        """
+        with self.lock:
+            self.load()
+            ids = set(clip["id"] for clip in clips)
+            self.db.delete_clips(list(ids))
+            self.clips = [c for c in self.clips if c["id"] not in ids]
+            self.incoming = deque(c for c in self.incoming if c["id"] not in ids)
+            for clip_id in ids:
+                self.ids.pop(clip_id, None)
+
+            # SQLite reuses the ids of the last rows once they are deleted
+            self.refreshed_id = min(self.refreshed_id, max(self.ids, default=0))
+            self.urls = {url: c for url, c in self.urls.items()
+                if c["id"] not in ids}
+            for clip in clips:
+                if self.hashes.get(clip.get("content_hash")) is clip:
+                    del self.hashes[clip["content_hash"]]
+
+    @classmethod
+    def filepath(cls, clip):
+        """Return disk location of a clip, preferring its normalized variant."""
+        return os.path.join(DATA_DIR, "clips",
+            clip.get("variant") or clip["filename"])
+
+    @classmethod
+    def filepaths(cls, clip):
+        """Return disk locations of the original and variant of a clip."""
+        return [os.path.join(DATA_DIR, "clips", name)
+            for name in (clip["filename"], clip.get("variant")) if name]
+
+    def find(self, url):
+        """Return the clip with the given url or None."""
+        self.load()
+        return self.urls.get(url)
+
+    def find_hash(self, content_hash):
+        """Return the clip with the given content hash or None."""
+        self.load()
+        return self.hashes.get(content_hash)
+
+    def add_alias(self, url, clip):
+        """Make an existing clip findable under another url."""
+        with self.lock:
+            self.load()
+            self.db.insert_clip_url(url, clip["id"])
+            self.urls[url] = clip
+
+    def pop_incoming(self):
+        """Return the oldest incoming clip and clear its incoming flag."""
+        with self.lock:
+            self.load()
+            if len(self.incoming) == 0:
+                return None
+            clip = self.incoming.popleft()
+            clip["incoming"] = False
+            self.db.update_clip(clip["id"], incoming=False)
+            return clip
+
+    def random(self):
+        """Return a random clip or None if there are no clips."""
+        with self.lock:
+            self.load()
+            if len(self.clips) == 0:
+                return None
+            return self.clips[randrange(len(self.clips))]
+
+
+catalog = Catalog(db)
+
+metrics.gauge("clips", "Clips in the catalog", lambda: len(catalog))
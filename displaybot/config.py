@@ -1,30 +1,152 @@
 # coding: utf-8
 
-"""Configuration."""
+"""Configuration.
 
+Importing this module has no side effects besides defining settings. The
+token is read and logging is set up when `Config.load` is called in `main`,
+the database is opened on first use.
+"""
+
+import binascii
 import logging
 import os
-import json
 
-from tinydb import TinyDB, Query
+import logs
+from storage import Storage
 
 # Setup db
 
 DATA_DIR = os.path.expanduser(os.path.join("~", "displaybot"))
 
-config_fname = os.path.join(DATA_DIR, "database.json")
-db = TinyDB(config_fname)
-
-TELEGRAM_API_TOKEN = "YOUR TOKEN HERE"
-with open(os.path.join(DATA_DIR, "TELEGRAM_API_TOKEN")) as f:
-    TELEGRAM_API_TOKEN = f.read().strip()
+config_fname = os.path.join(DATA_DIR, "displaybot.db")
+db = Storage(config_fname)
 
 # As anyone will be able to add the bot and add pictures to your display,
 # you can filter telegram usernames here
 ALLOWED_USERS = []
 SUPPORTED_TYPES = ["video/mp4", "video/webm", "image/gif"]
 SERVER_URL = "http://localhost:3000"
-playnext = None
+
+# Bot API server the bot talks to, None for api.telegram.org. Set it to a
+# local server like bench/fake_bot_api.py for testing, e.g.
+# "http://127.0.0.1:8081/bot".
+TELEGRAM_BASE_URL = None
+
+# All HTTP requests share a connection pool with keep-alive for up to
+# HTTP_POOL_HOSTS hosts. Requests time out after HTTP_CONNECT_TIMEOUT seconds
+# without a connection or HTTP_READ_TIMEOUT seconds without data and are
+# retried HTTP_RETRIES times. Clips larger than MAX_CLIP_BYTES are rejected.
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_READ_TIMEOUT = 30.0
+HTTP_RETRIES = 3
+HTTP_POOL_HOSTS = 10
+HTTP_POOL_SIZE = 10
+MAX_CLIP_BYTES = 50 * 1024 * 1024
+
+# Outbound Telegram messages are queued and sent at most OUTBOX_CHAT_RATE per
+# second to a chat, with bursts of OUTBOX_CHAT_BURST, and OUTBOX_GLOBAL_RATE
+# per second overall, following Telegram's flood limits for group chats.
+# At most OUTBOX_SIZE messages wait, ambient announcements are dropped first.
+OUTBOX_GLOBAL_RATE = 30.0
+OUTBOX_CHAT_RATE = 20 / 60.0
+OUTBOX_CHAT_BURST = 5
+OUTBOX_SIZE = 100
+
+# Collect metrics of downloads, transcoding, clip and station switches and
+# queue depths. They are served in Prometheus format at
+# http://127.0.0.1:METRICS_PORT/metrics and, if METRICS_DUMP_INTERVAL is not
+# zero, written to METRICS_DUMP_PATH every METRICS_DUMP_INTERVAL seconds.
+METRICS_ENABLED = False
+METRICS_PORT = 9110
+METRICS_DUMP_INTERVAL = 0
+METRICS_DUMP_PATH = os.path.join(DATA_DIR, "metrics.json")
+
+# Receive updates from Telegram on a local HTTP server instead of long
+# polling, at http://WEBHOOK_LISTEN:WEBHOOK_PORT/<secret>, e.g. behind a
+# reverse proxy that terminates TLS. The secret is read from the
+# WEBHOOK_SECRET file in the data directory and created if missing. If
+# WEBHOOK_URL is set, the webhook is registered with Telegram as
+# WEBHOOK_URL/<secret> on start. Up to WEBHOOK_QUEUE_SIZE updates wait to be
+# handled, further updates are refused and sent again by Telegram later.
+WEBHOOK_ENABLED = False
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8080
+WEBHOOK_URL = None
+WEBHOOK_QUEUE_SIZE = 100
+
+# Incoming clips are probed and downloaded by INGEST_WORKERS threads. New
+# links are rejected while INGEST_QUEUE_SIZE links are waiting.
+INGEST_WORKERS = 4
+INGEST_QUEUE_SIZE = 32
+
+# Clips are transcoded to fit the video player window by TRANSCODE_WORKERS
+# ffmpeg processes at a time
+DISPLAY_WIDTH = 810
+DISPLAY_HEIGHT = 540
+TRANSCODE_WORKERS = os.cpu_count() or 1
+
+# Clips are looped as often as they fit into CLIP_DWELL seconds. Clips
+# longer than that play once, but no longer than CLIP_MAX_DWELL seconds.
+CLIP_DWELL = 10.0
+CLIP_MAX_DWELL = 60.0
+
+# Preload the next clip in a second omxplayer instance and swap players
+# instead of loading clips into a single player. Needs more GPU memory.
+VIDEO_DOUBLE_BUFFER = False
+
+# Clip files may take up CLIP_STORE_BUDGET bytes, while at least
+# CLIP_STORE_MIN_FREE bytes stay free on the disk. Above either limit the
+# least valuable clips are deleted until CLIP_STORE_LOW_WATER of it is used.
+# Clips played more often count as if they were played later, by
+# CLIP_STORE_PLAY_CREDIT seconds for every doubling of their plays. The clips
+# directory is checked every CLIP_STORE_INTERVAL seconds, in batches of
+# CLIP_STORE_BATCH files. Files without a clip that are older than
+# CLIP_STORE_ORPHAN_AGE seconds are deleted, as are originals of clips that
+# have been transcoded and fingerprinted unless CLIP_STORE_KEEP_ORIGINALS.
+CLIP_STORE_BUDGET = 8 * 1024 * 1024 * 1024
+CLIP_STORE_MIN_FREE = 512 * 1024 * 1024
+CLIP_STORE_LOW_WATER = 0.9
+CLIP_STORE_PLAY_CREDIT = 24 * 3600
+CLIP_STORE_INTERVAL = 300
+CLIP_STORE_BATCH = 100
+CLIP_STORE_ORPHAN_AGE = 3600
+CLIP_STORE_KEEP_ORIGINALS = False
+
+# Wikipedia research is cached for RESEARCH_TTL seconds, or
+# RESEARCH_NEGATIVE_TTL seconds if nothing was found
+RESEARCH_CACHE_SIZE = 500
+RESEARCH_TTL = 7 * 24 * 3600
+RESEARCH_NEGATIVE_TTL = 24 * 3600
+
+# fip track metadata is requested when the current track ends, but at
+# least every FIP_POLL_MAX and at most every FIP_POLL_MIN seconds
+FIP_POLL_MIN = 5.0
+FIP_POLL_MAX = 120.0
+
+# Read stream titles from a separate connection to the station instead of
+# parsing mplayer's output
+RADIO_ICY_READER = True
+
+# Station streams are probed every STATION_PROBE_INTERVAL seconds to sort
+# the station keyboard, results older than STATION_PROBE_TTL are ignored
+STATION_PROBE_INTERVAL = 600
+STATION_PROBE_TTL = 1800
+STATION_PROBE_TIMEOUT = 5.0
+
+# Clips are reposts if at least half of their FINGERPRINT_FRAMES sampled
+# frames are within FINGERPRINT_DISTANCE bits of frames of a known clip.
+FINGERPRINT_FRAMES = 8
+FINGERPRINT_DISTANCE = 10
+
+# The log file is rotated when it reaches LOG_MAX_BYTES, keeping LOG_BACKUPS
+# old files. Records wait in a queue of LOG_QUEUE_SIZE for a background
+# writer and are dropped when it is full. Each debug message is logged at
+# most LOG_RATE_LIMIT times per LOG_RATE_PERIOD seconds.
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+LOG_QUEUE_SIZE = 10000
+LOG_RATE_LIMIT = 20
+LOG_RATE_PERIOD = 60.0
 
 logger = logging.getLogger("oxo")
 logger.setLevel(logging.DEBUG)
@@ -32,59 +154,89 @@ logger.setLevel(logging.DEBUG)
 jqlogger = logging.getLogger("JobQueue")
 jqlogger.setLevel(logging.WARNING)
 
-# create a file handler
-log_dir = os.path.join(DATA_DIR, "hello.log")
-handler = logging.FileHandler(log_dir)
-handler.setLevel(logging.DEBUG)
 
-# console handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
+class Config(object):
+    """Settings that need I/O to load, built once at startup."""
 
-# create a logging format
-logfmt = '%(asctime)s %(levelname)s\t: %(message)s'
-tmfmt = "%m/%d %H:%M:%S"
-formatter = logging.Formatter(logfmt, tmfmt)
-handler.setFormatter(formatter)
+    def __init__(self):
+        """Describe the files in the data directory."""
+        self.token_path = os.path.join(DATA_DIR, "TELEGRAM_API_TOKEN")
+        self.log_path = os.path.join(DATA_DIR, "hello.log")
+        self.webhook_secret_path = os.path.join(DATA_DIR, "WEBHOOK_SECRET")
+        self.token = None
+        self.webhook_secret = None
 
-logfmt1 = '%(asctime)s: %(message)s'
-formatter1 = logging.Formatter(logfmt1, tmfmt)
-console_handler.setFormatter(formatter1)
+    @classmethod
+    def load(cls):
+        """Set up logging, read the Telegram token and return the config."""
+        config = cls()
+        config.setup_logging()
+        with open(config.token_path) as f:
+            config.token = f.read().strip()
+        if WEBHOOK_ENABLED:
+            config.load_webhook_secret()
+        return config
 
-# add the handlers to the logger
-logger.addHandler(handler)
-jqlogger.addHandler(handler)
-logger.addHandler(console_handler)
-jqlogger.addHandler(console_handler)
+    def load_webhook_secret(self):
+        """Read the webhook secret, creating a random one on first use."""
+        if not os.path.exists(self.webhook_secret_path):
+            fd = os.open(self.webhook_secret_path,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(binascii.hexlify(os.urandom(16)).decode("ascii"))
+            logger.info("Created webhook secret in {}".format(
+                self.webhook_secret_path))
+        with open(self.webhook_secret_path) as f:
+            self.webhook_secret = f.read().strip()
 
-logger.info("Logging to {}".format(log_dir))
+    def setup_logging(self):
+        """Log to a rotating file in the data directory and the console."""
+        logs.configure(self.log_path, LOG_MAX_BYTES, LOG_BACKUPS,
+            LOG_QUEUE_SIZE, LOG_RATE_LIMIT, LOG_RATE_PERIOD,
+            loggers=("oxo", "JobQueue"))
+        logger.info("Logging to {}".format(self.log_path))
 
 
 def setup():
-    Config = Query()
-    if(len(db.search(Config.type == "radio")) == 0):
+    """Create the database, migrating or seeding it on first start.
+
+    The first start runs in one transaction, so that a failed migration
+    leaves the database empty and is tried again on the next start.
+    """
+    db.create()
+    tinydb_fname = os.path.join(DATA_DIR, "database.json")
+    with db.transaction():
+        migrated = seed_database(tinydb_fname)
+    if migrated:
+        os.rename(tinydb_fname, tinydb_fname + ".migrated")
+
+
+def seed_database(tinydb_fname):
+    """Fill a new database, return True if tinydb_fname was migrated."""
+    if db.radio() is None:
         logger.info("Seting up initial configuration\nFile: {}".format(config_fname))
-        db.remove(eids=[e.eid for e in db.all()])
+
+        # One-shot migration from the TinyDB database
+        migrated = os.path.exists(tinydb_fname)
+        if migrated:
+            try:
+                has_radio = db.migrate_tinydb(tinydb_fname)
+            except Exception as e:
+                logger.error("Migration failed: {}".format(e), exc_info=True)
+                raise
+            if has_radio:
+                return True
 
         try:
-            with open(os.path.join(DATA_DIR, "data.json")) as f:
-                data = json.load(f)
-                for clip in data["clips"]:
-                    clip["type"] = "clip"
-                    logger.info("Adding old clip {}".format(clip))
-                    db.insert(clip)
-                logger.warning("Please delete data.json")
+            db.import_data_json(os.path.join(DATA_DIR, "data.json"))
         except Exception:
             pass
 
-        radio = {
-            "type": "radio",
-            "station_playing": None,
-            "station_playing_sent": None,
-            "station_title": None,
-            "station_title_sent": None,
-        }
-        db.insert(radio)
+        db.insert_radio(
+            station_playing=None,
+            station_playing_sent=None,
+            station_title=None,
+            station_title_sent=None)
 
         stations = {
             "91.4": "http://138.201.251.233/brf_128",
@@ -100,13 +252,11 @@ def setup():
             "fip tout nouveau": "http://direct.fipradio.fr/live/fip-webradio5.mp3"
         }
 
-        db.insert_multiple([{"type": "station", "name": name, "url": url}
-            for name, url in list(stations.items())])
-
-        db.insert({"type": "incoming", "clip": {}})
+        db.insert_stations(stations)
+        return migrated
     else:
-        q = Query()
         logger.info("Database loaded with {} clips and {} stations.".format(
-            db.count(q.type == "clip"),
-            db.count(q.type == "station")
+            db.count_clips(),
+            db.count_stations()
         ))
+        return False
@@ -6,83 +6,132 @@ import logging
 import hashlib
 import os
 import datetime
-import ffmpy
-import requests
 
-from tinydb import Query
-from config import db, SUPPORTED_TYPES, DATA_DIR
+from threading import Event, Lock
 
-logger = logging.getLogger('oxo')
+import net
+from catalog import catalog
+from config import SUPPORTED_TYPES, DATA_DIR, MAX_CLIP_BYTES
 
+logger = logging.getLogger('oxo')
 
-def download_clip(url, bot, update, content_type, fname=None):
-    """Download clips."""
-    if not fname:
-        fname = hashlib.sha1(url.encode(encoding='UTF-8')).hexdigest()
-
-    author = update.message.from_user.first_name
-    if content_type not in SUPPORTED_TYPES:
-        logger.info("Link not supported: \n{}\nType{}".format(
-            url, content_type))
-        bot.sendMessage(chat_id=update.message.chat_id, text="👾 Link not supported. Only mp4, webm and gif links.")
-    elif duplicate(url):
-        logger.info("Detected duplicate {}".format(url))
-        update.message.reply_text("👾 Reposter!")
-    else:
-        fpath = os.path.join(DATA_DIR, "clips", fname)
-        logger.debug("Downloading clip to {}...".format(fpath))
-
-        with open(fpath, "wb+") as f:
-            r = requests.get(url, stream=True)
-
-            if r.ok:
-                for block in r.iter_content(1024):
-                    f.write(block)
-            else:
-                logger.error("Download failed {}".format(r))
-
-        # Convert gif files using ffmpeg
-        if url[-3:] == "gif":
-            fpath = convert_gif(fpath)
-            fname = os.path.basename(fpath)
-
-        clip = {
-            "type": "clip",
-            "url": url,
-            "author": author,
-            "filename": fname,
-            "created": datetime.datetime.now().isoformat(),
-            "incoming": True
-        }
-
-        db.insert(clip)
-        bot.sendMessage(chat_id=update.message.chat_id, text="👾 Added video to database.")
-        logger.info("Saved new clip {} from {}".format(fname, author))
+# Content hashes of clips being added, each with an event set once the clip
+# is registered or rejected
+adding = {}
+adding_lock = Lock()
+
+
+def probe(url):
+    """Return the content type of the resource at url or None."""
+    link = net.head(url)
+    logger.debug(link)
+    return link.headers.get("Content-Type")
+
+
+def download(url):
+    """Download url into the clips directory, named by its content hash.
+
+    The content is hashed while streaming into a partial file named after
+    the url, which is renamed once complete. An interrupted download resumes
+    from the partial file. Returns the file path and content hash. If a clip
+    with the same content exists, the url is added as an alias of that clip
+    and the returned file path is None.
+
+    If another url with the same content is being added, this waits for it
+    to finish. A returned file path claims the content hash until `release`
+    is called with it.
+    """
+    clips_dir = os.path.join(DATA_DIR, "clips")
+    logger.debug("Downloading clip {}...".format(url))
+
+    part_fpath = os.path.join(clips_dir, "{}.part".format(
+        hashlib.sha1(url.encode(encoding='UTF-8')).hexdigest()))
+    size, content_hash = net.download(
+        url, part_fpath, MAX_CLIP_BYTES, digest=hashlib.sha1)
+
+    clip = claim(content_hash)
+    if clip is not None:
+        os.remove(part_fpath)
+        catalog.add_alias(url, clip)
+        logger.info("Content of {} is known as clip {}".format(
+            url, clip["filename"]))
+        return None, content_hash
+
+    fpath = os.path.join(clips_dir, content_hash)
+    try:
+        os.replace(part_fpath, fpath)
+    except OSError:
+        release(content_hash)
+        raise
+    logger.debug("Saved clip to {} ({} bytes)".format(fpath, size))
+    return fpath, content_hash
+
+
+def claim(content_hash):
+    """Claim content for adding and return None, or return its known clip.
+
+    Blocks while another job adds the same content.
+    """
+    while True:
+        with adding_lock:
+            clip = catalog.find_hash(content_hash)
+            if clip is not None:
+                return clip
+            event = adding.get(content_hash)
+            if event is None:
+                adding[content_hash] = Event()
+                return None
+        event.wait()
+
+
+def release(content_hash):
+    """Let jobs waiting for the same content continue."""
+    with adding_lock:
+        event = adding.pop(content_hash, None)
+    if event is not None:
+        event.set()
+
+
+def register(url, author, fpath, content_hash=None, fingerprint=None,
+        variant=None, duration=None, frames=None):
+    """Add a downloaded clip to the catalog and return it."""
+    clip = {
+        "url": url,
+        "content_hash": content_hash,
+        "fingerprint": fingerprint,
+        "variant": os.path.basename(variant) if variant else None,
+        "duration": duration,
+        "frames": frames,
+        "size": disk_size(fpath, variant),
+        "author": author,
+        "filename": os.path.basename(fpath),
+        "created": datetime.datetime.now().isoformat(),
+        "incoming": True
+    }
+
+    clip = catalog.add(clip)
+    logger.info("Saved new clip {} from {}".format(clip["filename"], author))
+    return clip
+
+
+def remove(*fpaths):
+    """Delete clip files."""
+    for path in fpaths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def disk_size(*fpaths):
+    """Return the total size of the existing files in bytes."""
+    return sum(os.path.getsize(path) for path in fpaths
+        if path and os.path.exists(path))
+
+
+def supported(content_type):
+    """Boolean, true if clips of this content type can be played."""
+    return content_type in SUPPORTED_TYPES
 
 
 def duplicate(url):
-    """Boolean, true if given filenam exists in clips."""
-    Duplicate = Query()
-    return len(db.search(Duplicate.url == url)) > 0
-
-#
-# Converting gifs
-#
-
-
-def convert_gif(fpath):
-    """Convert gif at fpath using ffmpeg."""
-    logger.info("Converting gif to mp4...")
-
-    new_fpath = fpath + ".mp4"
-
-    ff = ffmpy.FFmpeg(
-        inputs={
-            fpath: None
-        },
-        outputs={
-            new_fpath: '-pix_fmt yuv420p -vf "scale=trunc(iw/2)*2:trunc(ih/2)*2"'
-        }
-    )
-    ff.run()
-    return new_fpath
+    """Boolean, true if a clip with the given url exists in the catalog."""
+    return catalog.find(url) is not None
@@ -3,32 +3,34 @@
 
 """The Displaybot should show a window on a small wall-mounted display that plays gifs and videos from a telegram group or tunes to a web radio station."""
 
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler
+import time
 
-from config import TELEGRAM_API_TOKEN, setup
-from bot import start, receive, shutdown, error
-from player.radio import Radio
-from player.video import Video
+STARTED = time.time()
 
+import logging  # noqa: E402
 
-def main():
-    """Main loop for the bot."""
-    setup()
+import metrics  # noqa: E402
+from config import Config, setup, WEBHOOK_ENABLED, TELEGRAM_BASE_URL  # noqa: E402
+
+logger = logging.getLogger('oxo')
+
+
+def add_handlers(dp):
+    """Register the command, callback and message handlers of the bot."""
+    from telegram.ext import CommandHandler, CallbackQueryHandler, \
+        MessageHandler
+    from bot import start, receive, shutdown, error
+    from player.radio import Radio
 
-    updater = Updater(TELEGRAM_API_TOKEN)
-    dp = updater.dispatcher
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler("shutdown", shutdown))
 
     # radio
     dp.add_handler(CommandHandler("radio",
         Radio.telegram_command,
-        pass_args=True,
-        pass_job_queue=True))
+        pass_args=True))
 
-    dp.add_handler(CallbackQueryHandler(
-        Radio.telegram_change_station,
-        pass_job_queue=True))
+    dp.add_handler(CallbackQueryHandler(Radio.telegram_change_station))
 
     # on noncommand i.e message - echo the message on Telegram
     dp.add_handler(MessageHandler(None, receive))
@@ -36,22 +38,61 @@ def main():
     # log all errors
     dp.add_error_handler(error)
 
-    # Start the Bot
-    updater.start_polling()
 
-    # Start the players
-    gif_player = Video()
+def main():
+    """Main loop for the bot."""
+    config = Config.load()
+    logger.info("Imported in {:.2f}s".format(time.time() - STARTED))
+    setup()
+    metrics.start()
+
+    # Start showing clips before connecting to Telegram, continuing where
+    # the last run stopped
+    from player.video import Video
+    from player.scheduler import scheduler
+    scheduler.restore()
+    gif_player = Video(started=STARTED)
     gif_player.setDaemon(True)
     gif_player.start()
 
+    # The telegram stack is only needed from here on
+    from telegram.ext import Updater
+    from ingest import pipeline
+    from player.radio import Radio
+    from player.probe import prober
+    from player.announcer import announcer
+    from store import store
+
+    updater = Updater(config.token, base_url=TELEGRAM_BASE_URL)
+    dp = updater.dispatcher
+    add_handlers(dp)
+
+    # Resume the radio station and title announcements of the last run
+    announcer.restore(updater.bot)
     radio = Radio()
     radio.setDaemon(True)
     radio.start()
 
+    # Start the Bot
+    pipeline.start()
+    if WEBHOOK_ENABLED:
+        from webhook import Receiver
+        receiver = Receiver(dp, config.webhook_secret)
+        receiver.start()
+    else:
+        updater.start_polling()
+    logger.info("Receiving Telegram updates {:.2f}s after start".format(
+        time.time() - STARTED))
+    prober.refresh()
+    store.start()
+
     # Run the bot until the you presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    if WEBHOOK_ENABLED:
+        receiver.idle()
+    else:
+        updater.idle()
 
     gif_player.stop()
     radio.stop()
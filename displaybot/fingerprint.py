@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Perceptual fingerprints for detecting re-encoded, resized or trimmed reposts.
+
+A fingerprint is a list of 64 bit difference hashes of frames sampled
+evenly over a clip. Flat frames, like black fades, are left out because all
+of them have the same hash. All frame hashes go into a multi-index hash
+table, so the frames of a new clip can be matched against every known clip
+by Hamming distance without a full scan.
+
+Run this file to fingerprint all clips in the database that don't have a
+fingerprint yet.
+"""
+
+import logging
+import os
+import subprocess
+import time
+
+from collections import Counter
+from itertools import combinations
+from multiprocessing import Pool, cpu_count
+from threading import RLock, Thread
+
+import ffmpy
+
+import transcode
+from catalog import catalog
+from config import DATA_DIR, FINGERPRINT_FRAMES, FINGERPRINT_DISTANCE
+
+logger = logging.getLogger('oxo')
+
+# Frames are scaled to HASH_WIDTH x HASH_HEIGHT grayscale pixels, comparing
+# horizontally adjacent pixels yields 8 x 8 = 64 bits per frame.
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+FRAME_SIZE = HASH_WIDTH * HASH_HEIGHT
+
+# Frames whose pixels have a lower standard deviation than this are flat
+MIN_STDDEV = 8.0
+
+# Hashes are split into BLOCKS blocks of BLOCK_BITS bits for the index
+BLOCKS = 4
+BLOCK_BITS = 64 // BLOCKS
+BLOCK_MASK = (1 << BLOCK_BITS) - 1
+
+
+def sample_frames(fpath, count=FINGERPRINT_FRAMES, duration=None):
+    """Return up to `count` tiny grayscale frames of a clip as bytes.
+
+    Frames are taken at even intervals over the clip, starting half an
+    interval in. Without a known duration the clip is probed, if that
+    fails two frames per second are taken from the start.
+    """
+    if duration is None:
+        try:
+            duration, frames = transcode.probe(fpath)
+        except Exception as e:
+            logger.debug("Could not probe {}: {}".format(fpath, e))
+
+    if duration:
+        seek = "-ss {:.3f}".format(duration / count / 2)
+        fps = "{:.6f}".format(count / duration)
+    else:
+        seek = None
+        fps = "2"
+
+    ff = ffmpy.FFmpeg(
+        global_options="-loglevel error",
+        inputs={
+            fpath: seek
+        },
+        outputs={
+            "pipe:1": '-vf "fps={},scale={}:{}" -frames:v {} '
+                '-pix_fmt gray -f rawvideo'.format(
+                    fps, HASH_WIDTH, HASH_HEIGHT, count)
+        }
+    )
+    out, err = ff.run(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return [out[i:i + FRAME_SIZE]
+        for i in range(0, len(out) - FRAME_SIZE + 1, FRAME_SIZE)]
+
+
+def dhash(frame):
+    """Return the 64 bit difference hash of a frame."""
+    rv = 0
+    for y in range(HASH_HEIGHT):
+        row = frame[y * HASH_WIDTH:(y + 1) * HASH_WIDTH]
+        for x in range(HASH_WIDTH - 1):
+            rv = (rv << 1) | (row[x] > row[x + 1])
+    return rv
+
+
+def flat(frame):
+    """Return True if a frame has too little contrast to tell it apart."""
+    mean = sum(frame) / len(frame)
+    variance = sum((p - mean) ** 2 for p in frame) / len(frame)
+    return variance < MIN_STDDEV ** 2
+
+
+def compute(fpath, duration=None):
+    """Return the fingerprint of a clip file as a list of frame hashes."""
+    return [dhash(frame) for frame in sample_frames(fpath, duration=duration)
+        if not flat(frame)]
+
+
+def encode(hashes):
+    """Return a fingerprint as a string for the database."""
+    return " ".join("{:016x}".format(h) for h in hashes)
+
+
+def decode(fingerprint):
+    """Return frame hashes of a fingerprint string."""
+    return [int(h, 16) for h in fingerprint.split()] if fingerprint else []
+
+
+def popcount(x):
+    """Number of bits set in x."""
+    return bin(x).count("1")
+
+
+if hasattr(int, "bit_count"):
+    popcount = int.bit_count  # noqa: F811
+
+
+def distance(a, b):
+    """Hamming distance of two hashes."""
+    return popcount(a ^ b)
+
+
+def flips(bits, radius):
+    """Return all masks of `bits` bits with at most `radius` bits set."""
+    return [sum(1 << i for i in c)
+        for r in range(radius + 1) for c in combinations(range(bits), r)]
+
+
+class MultiIndex(object):
+    """Multi-index hash table of hashes under the Hamming metric.
+
+    Each hash is split into BLOCKS blocks, with one table per block position
+    mapping block values to (hash, value) entries. Two hashes within
+    distance `radius` have at least one block within `radius // BLOCKS` of
+    each other, so a search only looks up the block values that close to
+    each block of the query and verifies the entries found there.
+    """
+
+    def __init__(self):
+        """Create an empty index."""
+        self.tables = [{} for i in range(BLOCKS)]
+        self.size = 0
+        self.masks = {}
+
+    def __len__(self):
+        """Number of hashes in the index."""
+        return self.size
+
+    def add(self, h, value):
+        """Insert a hash with an associated value."""
+        self.size += 1
+        entry = (h, value)
+        for i, table in enumerate(self.tables):
+            key = (h >> (i * BLOCK_BITS)) & BLOCK_MASK
+            bucket = table.get(key)
+            if bucket is None:
+                table[key] = [entry]
+            else:
+                bucket.append(entry)
+
+    def search(self, h, radius):
+        """Return (distance, value) pairs of hashes within radius of h.
+
+        A hash close in several blocks is returned once for each of them.
+        """
+        masks = self.masks.get(radius // BLOCKS)
+        if masks is None:
+            masks = self.masks[radius // BLOCKS] = flips(
+                BLOCK_BITS, radius // BLOCKS)
+
+        rv = []
+        for i, table in enumerate(self.tables):
+            key = (h >> (i * BLOCK_BITS)) & BLOCK_MASK
+            for mask in masks:
+                bucket = table.get(key ^ mask)
+                if bucket is None:
+                    continue
+                for other, value in bucket:
+                    d = popcount(h ^ other)
+                    if d <= radius:
+                        rv.append((d, value))
+        return rv
+
+
+class FingerprintIndex(object):
+    """Index of the frame hashes of all clips in the catalog."""
+
+    def __init__(self, catalog):
+        """Create an index that is filled from `catalog` on first use."""
+        self.catalog = catalog
+        self.table = MultiIndex()
+        self.lock = RLock()
+        self.loaded = False
+
+    def preload(self):
+        """Build the index in a background thread."""
+        t = Thread(target=self.load, name="fingerprint-index")
+        t.setDaemon(True)
+        t.start()
+
+    def load(self):
+        """Add fingerprints of all catalog clips to the index."""
+        with self.lock:
+            if self.loaded:
+                return
+            t0 = time.time()
+            for clip in self.catalog.all():
+                self._add(clip)
+            self.loaded = True
+            logger.debug("Fingerprint index built with {} hashes in {:.2f}s".format(
+                len(self.table), time.time() - t0))
+
+    def _add(self, clip):
+        """Insert the frame hashes of a clip into the index.
+
+        Fingerprints computed before flat frames were left out may contain
+        the hash of a flat frame, which is 0, it is skipped.
+        """
+        for h in decode(clip.get("fingerprint")):
+            if h != 0:
+                self.table.add(h, clip["id"])
+
+    def add(self, clip):
+        """Index the fingerprint of a newly added clip."""
+        with self.lock:
+            if self.loaded:
+                self._add(clip)
+
+    def match(self, hashes, radius=FINGERPRINT_DISTANCE):
+        """Return the id of a clip matching at least half the hashes or None."""
+        if len(hashes) == 0:
+            return None
+
+        self.load()
+        votes = Counter()
+        with self.lock:
+            for h in hashes:
+                votes.update(set(
+                    clip_id for d, clip_id in self.table.search(h, radius)))
+
+        # Hashes of removed clips stay in the index but don't count
+        for clip_id in list(votes):
+            if self.catalog.get(clip_id) is None:
+                del votes[clip_id]
+
+        if len(votes) > 0:
+            clip_id, count = votes.most_common(1)[0]
+            if count * 2 >= len(hashes):
+                return clip_id
+        return None
+
+
+index = FingerprintIndex(catalog)
+
+
+def _compute(clip):
+    """Pool worker returning clip id and encoded fingerprint."""
+    fpath = os.path.join(DATA_DIR, "clips", clip["filename"])
+    try:
+        return clip["id"], encode(compute(fpath, clip.get("duration")))
+    except Exception:
+        return clip["id"], None
+
+
+def fingerprint_all(processes=None):
+    """Fingerprint all catalog clips without a fingerprint in parallel."""
+    clips = [c for c in catalog.all() if not c.get("fingerprint")]
+    by_id = {c["id"]: c for c in clips}
+    logger.info("Fingerprinting {} clips...".format(len(clips)))
+
+    t0 = time.time()
+    done = 0
+    with Pool(processes or cpu_count()) as pool:
+        for clip_id, fingerprint in pool.imap_unordered(_compute, clips):
+            done += 1
+            if fingerprint is None:
+                logger.warning("Could not fingerprint clip {}".format(clip_id))
+            else:
+                catalog.update(by_id[clip_id], fingerprint=fingerprint)
+            if done % 100 == 0:
+                logger.info("{}/{} clips, {:.1f} clips/s".format(
+                    done, len(clips), done / (time.time() - t0)))
+    logger.info("Fingerprinted {} clips in {:.1f}s".format(
+        done, time.time() - t0))
+
+
+if __name__ == '__main__':
+    from config import Config, setup
+    Config().setup_logging()
+    setup()
+    fingerprint_all()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Import clips from a local directory or archive.
+
+Seeds the catalog with many clips at once, without sending them to the bot:
+
+    $ python3 displaybot/importer.py ~/clips --author Ada
+
+Directories are walked and files are hashed by a pool of threads. Files
+whose content is already in the catalog are skipped. New clips are copied
+into the clips directory under their content hash, transcoded to the
+display profile, probed and fingerprinted in parallel, just like clips
+sent to the bot, and near-duplicates of known clips are dropped. Clips are
+added to the database in batches.
+
+An interrupted import can be run again. Hashes of files seen before are
+remembered in the database, imported clips are skipped and finished
+transcodes are reused. A running bot picks up imported clips when its clip
+store next checks the clips directory.
+"""
+
+import argparse
+import hashlib
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import conversion
+import fingerprint
+import transcode
+from catalog import catalog
+from config import db, DATA_DIR, TRANSCODE_WORKERS
+
+logger = logging.getLogger('oxo')
+
+READ_SIZE = 1024 * 1024
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 5.0
+
+
+def walk(root, workers):
+    """Return paths of all files below root, scanning directories in parallel."""
+    def scan(path):
+        files, dirs = [], []
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+        return files, dirs
+
+    rv = []
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(scan, root)}
+        while pending:
+            future = next(as_completed(pending))
+            pending.remove(future)
+            try:
+                files, dirs = future.result()
+            except OSError as e:
+                logger.warning("Could not read directory: {}".format(e))
+                continue
+            rv.extend(files)
+            pending.update(pool.submit(scan, d) for d in dirs)
+    return sorted(rv)
+
+
+def supported(fpath):
+    """Return True if the file looks like a clip by its name."""
+    content_type, encoding = mimetypes.guess_type(fpath)
+    return conversion.supported(content_type)
+
+
+def file_hash(fpath):
+    """Return the sha1 hex digest of a file, as used for downloaded clips."""
+    digest = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prepare(src, content_hash):
+    """Copy a file into the clips directory and transcode and inspect it.
+
+    Steps that were finished by an earlier, interrupted import are skipped,
+    their files are touched so that the clip store of a running bot doesn't
+    take them for orphans. Returns the clip file, its variant, duration,
+    frames, frame hashes and the id of a known clip it's a repost of.
+    """
+    fpath = os.path.join(DATA_DIR, "clips", content_hash)
+    if os.path.exists(fpath):
+        os.utime(fpath)
+    else:
+        shutil.copyfile(src, fpath + ".part")
+        os.replace(fpath + ".part", fpath)
+
+    variant = transcode.variant_path(fpath)
+    if os.path.exists(variant):
+        os.utime(variant)
+    else:
+        transcode.transcode_file(fpath)
+
+    try:
+        duration, frames = transcode.probe(variant)
+    except Exception as e:
+        logger.warning("Could not probe {}: {}".format(variant, e))
+        duration, frames = None, None
+    hashes = fingerprint.compute(variant, duration)
+    return (fpath, variant, duration, frames, hashes,
+        fingerprint.index.match(hashes))
+
+
+class Importer(object):
+    """Import the clips below a directory."""
+
+    def __init__(self, root, author, workers=TRANSCODE_WORKERS,
+            hash_workers=None, batch=100, name=None, archive=False):
+        """Describe an import, `name` identifies it for resuming.
+
+        Files unpacked from an archive get new modification times, so for
+        those only the size tells whether a file changed.
+        """
+        self.root = root
+        self.archive = archive
+        self.author = author
+        self.workers = workers
+        self.hash_workers = hash_workers or 2 * (os.cpu_count() or 1)
+        self.batch = batch
+        self.name = "import:{}".format(name or os.path.abspath(root))
+
+        # Previous state: relative path to [size, mtime, hash]
+        self.state = db.snapshot(self.name) or {"files": {}, "rejected": []}
+        self.rejected = set(self.state["rejected"])
+
+        self.t0 = time.time()
+        self.reported = self.t0
+        self.total = 0
+        self.done = 0
+        self.bytes = 0
+        self.added = 0
+        self.known = 0
+        self.failed = 0
+        self.pending = []
+
+    def run(self):
+        """Import all clips and return the number of clips added."""
+        # Build the index of known fingerprints while files are hashed
+        fingerprint.index.preload()
+
+        fpaths = [p for p in walk(self.root, self.hash_workers) if supported(p)]
+        self.total = len(fpaths)
+        logger.info("Found {} clips in {} in {:.1f}s".format(
+            self.total, self.root, time.time() - self.t0))
+
+        hashes = self.hash_all(fpaths)
+
+        # Keep one file per content that isn't known yet
+        todo = {}
+        for fpath, content_hash in hashes.items():
+            if catalog.find_hash(content_hash) is not None \
+                    or content_hash in self.rejected or content_hash in todo:
+                self.known += 1
+                self.done += 1
+            else:
+                todo[content_hash] = fpath
+        logger.info("Importing {} new clips, {} known".format(
+            len(todo), self.known))
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = {pool.submit(prepare, fpath, content_hash):
+                (fpath, content_hash) for content_hash, fpath in todo.items()}
+            for future in as_completed(futures):
+                self.collect(future, *futures[future])
+        self.flush()
+
+        logger.info("Imported {} clips in {:.1f}s, {} known, {} failed".format(
+            self.added, time.time() - self.t0, self.known, self.failed))
+        return self.added
+
+    def hash_all(self, fpaths):
+        """Return the content hashes of files by path, reusing earlier ones."""
+        files = self.state["files"]
+        rv = {}
+        todo = []
+        for fpath in fpaths:
+            key = os.path.relpath(fpath, self.root)
+            entry = files.get(key)
+            if entry is not None and entry[:2] == self.stamp(fpath):
+                rv[fpath] = entry[2]
+            else:
+                todo.append(fpath)
+        logger.info("Hashing {} files, {} hashed before".format(
+            len(todo), len(rv)))
+
+        t0 = time.time()
+        with ThreadPoolExecutor(self.hash_workers) as pool:
+            futures = {pool.submit(file_hash, fpath): fpath for fpath in todo}
+            for i, future in enumerate(as_completed(futures)):
+                fpath = futures[future]
+                try:
+                    content_hash = future.result()
+                    stamp = self.stamp(fpath)
+                except OSError as e:
+                    logger.warning("Could not read {}: {}".format(fpath, e))
+                    self.failed += 1
+                    self.done += 1
+                    continue
+                rv[fpath] = content_hash
+                files[os.path.relpath(fpath, self.root)] = stamp + [content_hash]
+                self.bytes += stamp[0]
+                if self.due():
+                    logger.info("Hashed {}/{} files, {:.1f} MB/s".format(
+                        i + 1, len(todo), self.bytes / 1e6 / (time.time() - t0)))
+        if len(todo) > 0:
+            logger.info("Hashed {} files in {:.1f}s, {:.1f} MB/s".format(
+                len(todo), time.time() - t0,
+                self.bytes / 1e6 / max(time.time() - t0, 1e-6)))
+        self.save()
+        return rv
+
+    def stamp(self, fpath):
+        """Return size and modification time of a file."""
+        st = os.stat(fpath)
+        return [st.st_size, None if self.archive else int(st.st_mtime)]
+
+    def collect(self, future, src, content_hash):
+        """Queue a prepared clip for insertion, dropping near-duplicates."""
+        self.done += 1
+        try:
+            fpath, variant, duration, frames, hashes, match = future.result()
+        except Exception as e:
+            logger.warning("Could not import {}: {}".format(src, e))
+            self.failed += 1
+        else:
+            if match is None:
+                match = self.match_pending(hashes)
+            if match is not None:
+                logger.info("{} is a near-duplicate of clip {}".format(
+                    src, match))
+                conversion.remove(fpath, variant)
+                self.rejected.add(content_hash)
+                self.known += 1
+            else:
+                self.pending.append({
+                    "url": "file://" + os.path.abspath(src),
+                    "author": self.author,
+                    "filename": os.path.basename(fpath),
+                    "created": datetime.now().isoformat(),
+                    "incoming": False,
+                    "content_hash": content_hash,
+                    "fingerprint": fingerprint.encode(hashes),
+                    "variant": os.path.basename(variant),
+                    "duration": duration,
+                    "frames": frames,
+                    "size": conversion.disk_size(fpath, variant)
+                })
+                if len(self.pending) >= self.batch:
+                    self.flush()
+        self.report()
+
+    def match_pending(self, hashes):
+        """Return the file name of a clip waiting to be added that matches."""
+        for clip in self.pending:
+            known = fingerprint.decode(clip["fingerprint"])
+            close = sum(1 for h in hashes if any(
+                fingerprint.distance(h, k) <= fingerprint.FINGERPRINT_DISTANCE
+                for k in known))
+            if len(hashes) > 0 and close * 2 >= len(hashes):
+                return clip["filename"]
+        return None
+
+    def flush(self):
+        """Add waiting clips to the catalog and remember progress."""
+        if len(self.pending) > 0:
+            for clip in catalog.add_many(self.pending):
+                fingerprint.index.add(clip)
+            self.added += len(self.pending)
+            self.pending = []
+        self.save()
+
+    def save(self):
+        """Persist hashes and rejected clips for resuming."""
+        self.state["rejected"] = sorted(self.rejected)
+        db.save_snapshot(self.name, self.state)
+
+    def due(self):
+        """Return True if it's time for another progress report."""
+        now = time.time()
+        if now - self.reported < PROGRESS_INTERVAL:
+            return False
+        self.reported = now
+        return True
+
+    def report(self):
+        """Log progress and throughput of adding clips every few seconds."""
+        if not self.due():
+            return
+        elapsed = time.time() - self.t0
+        logger.info("{}/{} clips, {:.1f} clips/s, {} added, {} known, "
+            "{} failed".format(self.done, self.total, self.done / elapsed,
+                self.added + len(self.pending), self.known, self.failed))
+
+
+def main():
+    """Import clips from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="directory or archive with clips")
+    parser.add_argument("--author", default="import",
+        help="author recorded for the imported clips")
+    parser.add_argument("--workers", type=int, default=TRANSCODE_WORKERS,
+        help="clips transcoded at a time")
+    parser.add_argument("--batch", type=int, default=100,
+        help="clips added to the database per transaction")
+    args = parser.parse_args()
+
+    from config import Config, setup
+    Config().setup_logging()
+    setup()
+
+    if os.path.isdir(args.source):
+        Importer(args.source, args.author, args.workers,
+            batch=args.batch).run()
+        return
+
+    # Archives are unpacked next to the clips directory
+    tmp_dir = tempfile.mkdtemp(prefix="import-", dir=DATA_DIR)
+    try:
+        logger.info("Unpacking {}...".format(args.source))
+        shutil.unpack_archive(args.source, tmp_dir)
+        importer = Importer(tmp_dir, args.author, args.workers,
+            batch=args.batch, name=os.path.abspath(args.source), archive=True)
+        importer.run()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
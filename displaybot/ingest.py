@@ -0,0 +1,252 @@
+# coding: utf-8
+
+"""Ingest pipeline for incoming clips."""
+
+import logging
+
+from queue import Queue, Full
+from threading import Thread, Lock
+
+import conversion
+import fingerprint
+import metrics
+import net
+import transcode
+from outbox import outbox
+from config import INGEST_QUEUE_SIZE, INGEST_WORKERS, TRANSCODE_WORKERS
+
+logger = logging.getLogger('oxo')
+
+ingest_failures = metrics.counter("ingest_failures_total",
+    "Clips that failed in a stage of the ingest pipeline")
+
+
+class IngestJob(object):
+    """A single clip moving through the ingest pipeline."""
+
+    def __init__(self, bot, chat_id, message_id, author,
+            url=None, file_id=None, content_type=None):
+        """Describe a clip by url or Telegram file id."""
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.author = author
+        self.url = url
+        self.file_id = file_id
+        self.key = url or file_id
+        self.content_type = content_type
+        self.fpath = None
+        self.variant = None
+        self.duration = None
+        self.frames = None
+        self.content_hash = None
+        self.fingerprint = None
+        self.clip = None
+
+    def __repr__(self):
+        """Show url of the job."""
+        return "<IngestJob {}>".format(self.url or self.file_id)
+
+    def reply(self, text):
+        """Reply to the message this job came from."""
+        outbox.send_message(self.bot, self.chat_id, text,
+            reply_to_message_id=self.message_id)
+
+
+class Stage(object):
+    """Worker threads reading jobs from a bounded queue.
+
+    Each job is passed to `func`, which returns the job if it should continue
+    to the next stage. Putting into a full queue blocks, so slow stages hold
+    back the ones before them.
+    """
+
+    def __init__(self, name, func, workers, size, error):
+        """Create stage with `workers` threads and a queue of `size`."""
+        self.name = name
+        self.func = func
+        self.error = error
+        self.queue = Queue(size)
+        self.workers = workers
+        self.next = None
+
+    def start(self):
+        """Start worker threads."""
+        for i in range(self.workers):
+            t = Thread(target=self.work, name="{}-{}".format(self.name, i))
+            t.setDaemon(True)
+            t.start()
+
+    def work(self):
+        """Process jobs until the program exits."""
+        while True:
+            job = self.queue.get()
+            try:
+                rv = self.func(job)
+            except Exception as e:
+                logger.error("Ingest {} failed for {}: {}".format(
+                    self.name, job, e), exc_info=True)
+                ingest_failures.inc()
+                pipeline.done(job)
+                job.reply(self.error)
+            else:
+                if rv is None or self.next is None:
+                    pipeline.done(job)
+                else:
+                    self.next.queue.put(rv)
+            finally:
+                self.queue.task_done()
+
+
+class Pipeline(object):
+    """Probe, download, convert and register clips in the background."""
+
+    def __init__(self):
+        """Create the stages."""
+        self.stages = [
+            Stage("probe", probe, INGEST_WORKERS, INGEST_QUEUE_SIZE,
+                "👾 Link not valid"),
+            Stage("download", download, INGEST_WORKERS, INGEST_WORKERS,
+                "👾 Download failed"),
+            Stage("convert", convert, TRANSCODE_WORKERS, INGEST_WORKERS,
+                "👾 Conversion failed"),
+            Stage("fingerprint", match, TRANSCODE_WORKERS, INGEST_WORKERS,
+                "👾 Could not inspect this clip"),
+            Stage("register", register, 1, INGEST_WORKERS,
+                "👾 Could not add video to database")
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+
+        self.lock = Lock()
+        self.pending = set()
+        self.started = False
+
+    def start(self):
+        """Start all stages."""
+        with self.lock:
+            if not self.started:
+                for stage in self.stages:
+                    stage.start()
+                fingerprint.index.preload()
+                self.started = True
+
+    def submit(self, job):
+        """Queue a job without blocking.
+
+        Returns False if the queue is full or the url is already being added.
+        """
+        self.start()
+        with self.lock:
+            if job.key in self.pending:
+                return False
+            self.pending.add(job.key)
+        try:
+            self.stages[0].queue.put_nowait(job)
+        except Full:
+            self.done(job)
+            return False
+        return True
+
+    def done(self, job):
+        """Forget about a finished job and release the content it claimed."""
+        with self.lock:
+            self.pending.discard(job.key)
+        if job.fpath is not None:
+            conversion.release(job.content_hash)
+
+    def join(self):
+        """Block until all queued jobs are done."""
+        for stage in self.stages:
+            stage.queue.join()
+
+#
+# Stages
+#
+
+
+def probe(job):
+    """Find download url and content type, reject duplicates."""
+    if job.file_id is not None:
+        file_data = job.bot.getFile(job.file_id)
+        job.url = file_data["file_path"]
+
+    if job.content_type is None:
+        job.content_type = conversion.probe(job.url)
+        if job.content_type is None:
+            logger.info("Link not supported: {}".format(job.url))
+            job.reply("👾 Link not supported. Only mp4, webm and gif links.")
+            return None
+
+    if not conversion.supported(job.content_type):
+        logger.info("Link not supported: \n{}\nType{}".format(
+            job.url, job.content_type))
+        job.reply("👾 Link not supported. Only mp4, webm and gif links.")
+    elif conversion.duplicate(job.url):
+        logger.info("Detected duplicate {}".format(job.url))
+        job.reply("👾 Reposter!")
+    else:
+        return job
+
+
+def download(job):
+    """Download the clip, rejecting known content and oversized files."""
+    try:
+        job.fpath, job.content_hash = conversion.download(job.url)
+    except net.TooLarge as e:
+        logger.info("Rejected large clip: {}".format(e))
+        job.reply("👾 Clip too large.")
+        return None
+    if job.fpath is None:
+        logger.info("Detected duplicate content {}".format(job.url))
+        job.reply("👾 Reposter!")
+        return None
+    return job
+
+
+def convert(job):
+    """Transcode the clip to the display profile."""
+    try:
+        job.variant = transcode.normalize(job.fpath)
+    except Exception:
+        conversion.remove(job.fpath)
+        raise
+
+    try:
+        job.duration, job.frames = transcode.probe(job.variant)
+    except Exception as e:
+        logger.warning("Could not probe {}: {}".format(job.variant, e))
+    return job
+
+
+def match(job):
+    """Fingerprint the clip, rejecting near-duplicates of known clips."""
+    hashes = fingerprint.compute(job.variant, job.duration)
+    clip_id = fingerprint.index.match(hashes)
+    if clip_id is not None:
+        logger.info("Detected near-duplicate {} of clip {}".format(
+            job.url, clip_id))
+        conversion.remove(job.fpath, job.variant)
+        job.reply("👾 Reposter!")
+        return None
+    job.fingerprint = fingerprint.encode(hashes)
+    return job
+
+
+def register(job):
+    """Add the clip to the catalog and notify the chat."""
+    job.clip = conversion.register(job.url, job.author, job.fpath,
+        content_hash=job.content_hash,
+        fingerprint=job.fingerprint,
+        variant=job.variant,
+        duration=job.duration,
+        frames=job.frames)
+    fingerprint.index.add(job.clip)
+    job.reply("👾 Added video to database.")
+    return job
+
+
+pipeline = Pipeline()
+
+metrics.gauge("ingest_queue_depth", "Jobs waiting for a stage of the ingest pipeline",
+    lambda: {s.name: s.queue.qsize() for s in pipeline.stages}, label="stage")
@@ -0,0 +1,130 @@
+# coding: utf-8
+
+"""Logging that keeps disk writes off the player and dispatcher threads.
+
+Records are put on a bounded queue and written by a background listener to
+a size-rotated log file and the console. Debug records are rate limited per
+call site, so a message logged for every line of mplayer output or every
+clip can't flood the SD card. Levels can be changed at runtime with
+`set_level` or by sending SIGUSR1, which toggles debug logging.
+"""
+
+import atexit
+import logging
+import signal
+import time
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Queue, Full
+from threading import Lock
+
+LOG_FORMAT = '%(asctime)s %(levelname)s\t: %(message)s'
+CONSOLE_FORMAT = '%(asctime)s: %(message)s'
+TIME_FORMAT = "%m/%d %H:%M:%S"
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most `limit` records per call site in `period` seconds.
+
+    Only records below `level` are limited. The first record let through
+    after some were suppressed says how many.
+    """
+
+    def __init__(self, limit, period, level=logging.INFO):
+        """Create filter."""
+        super(RateLimitFilter, self).__init__()
+        self.limit = limit
+        self.period = period
+        self.level = level
+        self.sites = {}
+        self.lock = Lock()
+
+    def filter(self, record):
+        """Return True if record should be logged."""
+        if record.levelno >= self.level:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = time.time()
+        with self.lock:
+            start, count, suppressed = self.sites.get(key, (now, 0, 0))
+            if now - start >= self.period:
+                start, count = now, 0
+            if count >= self.limit:
+                self.sites[key] = (start, count, suppressed + 1)
+                return False
+            self.sites[key] = (start, count + 1, 0)
+
+        if suppressed > 0:
+            record.msg = "{} ({} similar messages suppressed)".format(
+                record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of blocking when full."""
+
+    def __init__(self, queue):
+        """Create handler."""
+        super(DroppingQueueHandler, self).__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        """Put record on the queue unless it is full."""
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+file_handler = None
+queue_handler = None
+listener = None
+
+
+def configure(log_path, max_bytes, backups, queue_size, rate_limit,
+        rate_period, loggers=("oxo",)):
+    """Route the given loggers through a queue to a rotating file and console."""
+    global file_handler, queue_handler, listener
+
+    file_handler = RotatingFileHandler(log_path,
+        maxBytes=max_bytes, backupCount=backups)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, TIME_FORMAT))
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT, TIME_FORMAT))
+
+    queue_handler = DroppingQueueHandler(Queue(queue_size))
+    queue_handler.addFilter(RateLimitFilter(rate_limit, rate_period))
+    for name in loggers:
+        logging.getLogger(name).addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, file_handler, console_handler,
+        respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    if hasattr(signal, "SIGUSR1"):
+        try:
+            signal.signal(signal.SIGUSR1, toggle_debug)
+        except ValueError:
+            # Not in the main thread
+            pass
+
+
+def set_level(level, name="oxo"):
+    """Change the level of a logger at runtime, e.g. `set_level("INFO")`."""
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    logging.getLogger(name).setLevel(level)
+    logging.getLogger("oxo").warning("Log level of {} set to {}".format(
+        name, logging.getLevelName(level)))
+
+
+def toggle_debug(signum=None, frame=None):
+    """Switch the bot logger between DEBUG and INFO."""
+    logger = logging.getLogger("oxo")
+    set_level(logging.INFO if logger.level <= logging.DEBUG else logging.DEBUG)
@@ -0,0 +1,333 @@
+# coding: utf-8
+
+"""Counters, gauges and latency histograms for the hot paths of the bot.
+
+Metrics are defined at module level where they are measured:
+
+    download_seconds = metrics.histogram("download_seconds", "Clip downloads")
+
+    with download_seconds.time():
+        ...
+
+They are served in the Prometheus text format on a local HTTP port and can
+be dumped to a JSON file periodically. If METRICS_ENABLED is off, all
+metrics are shared no-op objects, so measuring costs one method call.
+"""
+
+import json
+import logging
+import os
+import time
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+
+from config import METRICS_ENABLED, METRICS_PORT, METRICS_DUMP_INTERVAL, \
+    METRICS_DUMP_PATH
+
+logger = logging.getLogger('oxo')
+
+PREFIX = "displaybot_"
+
+# Latency buckets in seconds, from a cached db query to a slow transcode
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0, 120.0)
+
+
+class Timer(object):
+    """Context manager observing the time spent in its block."""
+
+    def __init__(self, histogram):
+        """Time into histogram."""
+        self.histogram = histogram
+
+    def __enter__(self):
+        """Start timing."""
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        """Observe elapsed time."""
+        self.histogram.observe(time.time() - self.t0)
+
+
+class Counter(object):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        """Create counter at zero."""
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        """Increase the counter."""
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        """Return (suffix, labels, value) triples."""
+        return [("", None, self.value)]
+
+    def dump(self):
+        """Return a json serializable value."""
+        return self.value
+
+
+class Gauge(object):
+    """A value that is set, or read from `func` when collected.
+
+    If `label` is given, `func` returns a dict of values by label value.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, func=None, label=None):
+        """Create gauge."""
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+        self.value = 0
+
+    def set(self, value):
+        """Set the gauge."""
+        self.value = value
+
+    def read(self):
+        """Return the current value or values by label."""
+        if self.func is None:
+            return self.value
+        try:
+            return self.func()
+        except Exception as e:
+            logger.debug("Could not read gauge {}: {}".format(self.name, e))
+            return {} if self.label else 0
+
+    def samples(self):
+        """Return (suffix, labels, value) triples."""
+        value = self.read()
+        if self.label is None:
+            return [("", None, value)]
+        return [("", {self.label: k}, v) for k, v in sorted(value.items())]
+
+    def dump(self):
+        """Return a json serializable value."""
+        return self.read()
+
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        """Create empty histogram."""
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        """Record a value."""
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Return a context manager observing the duration of its block."""
+        return Timer(self)
+
+    def samples(self):
+        """Return (suffix, labels, value) triples."""
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        rv = []
+        cumulative = 0
+        for le, n in zip(self.buckets, counts):
+            cumulative += n
+            rv.append(("_bucket", {"le": repr(le)}, cumulative))
+        rv.append(("_bucket", {"le": "+Inf"}, count))
+        rv.append(("_sum", None, total))
+        rv.append(("_count", None, count))
+        return rv
+
+    def dump(self):
+        """Return a json serializable value."""
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else None,
+                "buckets": dict(zip([repr(b) for b in self.buckets] + ["+Inf"],
+                    self.counts))
+            }
+
+
+class NullMetric(object):
+    """Stand-in for all metrics when metrics are disabled."""
+
+    def inc(self, amount=1):
+        """Do nothing."""
+
+    def set(self, value):
+        """Do nothing."""
+
+    def observe(self, value):
+        """Do nothing."""
+
+    def time(self):
+        """Return a context manager that does nothing."""
+        return self
+
+    def __enter__(self):
+        """Do nothing."""
+        return self
+
+    def __exit__(self, *exc):
+        """Do nothing."""
+
+
+NULL = NullMetric()
+
+
+class Registry(object):
+    """All metrics of the process by name."""
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        """Create empty registry."""
+        self.enabled = enabled
+        self.metrics = {}
+        self.lock = Lock()
+
+    def register(self, metric):
+        """Add a metric, returning an existing one of the same name."""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        """Return a counter."""
+        if not self.enabled:
+            return NULL
+        return self.register(Counter(PREFIX + name, help))
+
+    def gauge(self, name, help, func=None, label=None):
+        """Return a gauge, read from `func` when collected if given."""
+        if not self.enabled:
+            return NULL
+        return self.register(Gauge(PREFIX + name, help, func, label))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        """Return a latency histogram."""
+        if not self.enabled:
+            return NULL
+        return self.register(Histogram(PREFIX + name, help, buckets))
+
+    def collect(self):
+        """Return all metrics sorted by name."""
+        with self.lock:
+            return [self.metrics[k] for k in sorted(self.metrics)]
+
+    def prometheus(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for m in self.collect():
+            lines.append("# HELP {} {}".format(m.name, m.help))
+            lines.append("# TYPE {} {}".format(m.name, m.kind))
+            for suffix, labels, value in m.samples():
+                if labels:
+                    labels = "{{{}}}".format(",".join('{}="{}"'.format(k, v)
+                        for k, v in labels.items()))
+                lines.append("{}{}{} {}".format(
+                    m.name, suffix, labels or "", value))
+        return "\n".join(lines) + "\n"
+
+    def json(self):
+        """Return all metrics as a dict."""
+        rv = {m.name: m.dump() for m in self.collect()}
+        rv["time"] = time.time()
+        return rv
+
+    def dump(self, fpath):
+        """Write all metrics to a json file."""
+        tmp_fpath = fpath + ".tmp"
+        with open(tmp_fpath, "w") as f:
+            json.dump(self.json(), f, indent=2, sort_keys=True)
+        os.replace(tmp_fpath, fpath)
+
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in a thread."""
+
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve /metrics as Prometheus text and /metrics.json as json."""
+
+    def do_GET(self):
+        """Answer a scrape."""
+        if self.path == "/metrics":
+            body = registry.prometheus()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(registry.json(), indent=2, sort_keys=True)
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """Don't log scrapes."""
+
+
+def dump_periodically(fpath, interval):
+    """Write metrics to fpath every `interval` seconds."""
+    while True:
+        time.sleep(interval)
+        try:
+            registry.dump(fpath)
+        except (IOError, OSError) as e:
+            logger.error("Could not dump metrics: {}".format(e))
+
+
+def start(port=METRICS_PORT, interval=METRICS_DUMP_INTERVAL):
+    """Serve metrics on localhost and start dumping them if configured."""
+    if not registry.enabled:
+        return
+
+    if port:
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        t = Thread(target=server.serve_forever, name="metrics")
+        t.setDaemon(True)
+        t.start()
+        logger.info("Serving metrics at http://127.0.0.1:{}/metrics".format(
+            port))
+
+    if interval:
+        t = Thread(target=dump_periodically, args=(METRICS_DUMP_PATH, interval),
+            name="metrics-dump")
+        t.setDaemon(True)
+        t.start()
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+"""HTTP client shared by all network calls of the bot.
+
+One `requests` session keeps connections alive per host. Every request gets
+connect and read timeouts, idempotent requests are retried with backoff and
+downloads are capped in size and resumed with Range requests.
+"""
+
+import logging
+import os
+import time
+
+import requests
+
+import metrics
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from config import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, \
+    HTTP_POOL_HOSTS, HTTP_POOL_SIZE
+
+logger = logging.getLogger('oxo')
+
+TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+# Read size for streaming downloads
+CHUNK_SIZE = 64 * 1024
+
+download_seconds = metrics.histogram("download_seconds",
+    "Time to download a clip")
+download_bytes = metrics.counter("download_bytes_total",
+    "Bytes of downloaded clips")
+download_retries = metrics.counter("download_retries_total",
+    "Interrupted downloads that were resumed")
+
+
+class TooLarge(IOError):
+    """Raised when a download exceeds its size limit."""
+
+
+def make_session():
+    """Return a session with connection pooling and retries."""
+    session = requests.Session()
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = "displaybot"
+    return session
+
+
+session = make_session()
+
+
+def request(method, url, **kwargs):
+    """Send a request through the shared session with default timeouts."""
+    kwargs.setdefault("timeout", TIMEOUT)
+    return session.request(method, url, **kwargs)
+
+
+def head(url, **kwargs):
+    """Send a HEAD request."""
+    kwargs.setdefault("allow_redirects", True)
+    return request("HEAD", url, **kwargs)
+
+
+def get(url, **kwargs):
+    """Send a GET request."""
+    return request("GET", url, **kwargs)
+
+
+def download(url, fpath, max_bytes, digest=None):
+    """Download url into fpath, resuming a partial file left by earlier tries.
+
+    If fpath already exists, only the missing bytes are requested with a
+    Range header. If `digest` is a hashlib constructor, the complete file is
+    hashed while streaming. Returns the size and hex digest of the file.
+    Raises TooLarge if the download exceeds max_bytes, in which case fpath is
+    removed.
+    """
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            with download_seconds.time():
+                size, hexdigest = _download(url, fpath, max_bytes, digest)
+            download_bytes.inc(size)
+            return size, hexdigest
+        except TooLarge:
+            if os.path.exists(fpath):
+                os.remove(fpath)
+            raise
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            if attempt == HTTP_RETRIES:
+                raise
+            logger.warning("Download of {} interrupted, resuming: {}".format(
+                url, e))
+            download_retries.inc()
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def _download(url, fpath, max_bytes, digest):
+    """Single download attempt, see `download`."""
+    offset = os.path.getsize(fpath) if os.path.exists(fpath) else 0
+    headers = {"Range": "bytes={}-".format(offset)} if offset > 0 else {}
+    h = digest() if digest is not None else None
+
+    r = get(url, stream=True, headers=headers)
+    try:
+        if r.status_code == 416:
+            # Range not satisfiable, start over
+            r.close()
+            r = get(url, stream=True)
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            offset = 0
+        length = r.headers.get("Content-Length")
+        if length is not None and offset + int(length) > max_bytes:
+            raise TooLarge("{} is {} bytes".format(url, offset + int(length)))
+
+        if offset > 0:
+            logger.debug("Resuming {} at {} bytes".format(url, offset))
+            if h is not None:
+                with open(fpath, "rb") as f:
+                    for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        h.update(block)
+
+        size = offset
+        with open(fpath, "ab" if offset > 0 else "wb") as f:
+            for block in r.iter_content(CHUNK_SIZE):
+                size += len(block)
+                if size > max_bytes:
+                    raise TooLarge("{} exceeds {} bytes".format(url, max_bytes))
+                if h is not None:
+                    h.update(block)
+                f.write(block)
+    finally:
+        r.close()
+    return size, h.hexdigest() if h is not None else None
@@ -0,0 +1,251 @@
+# coding: utf-8
+
+"""Rate limited queue for outbound Telegram messages.
+
+Telegram rejects bots that send more than about one message per second to a
+chat or thirty messages per second overall. Instead of calling the Bot API
+from whatever thread produced a message, messages are queued here and sent
+by a single thread that keeps within those limits.
+
+Messages are sent in priority order, replies to commands before ambient
+announcements. A message can carry a coalescing key: if a message with the
+same key is still waiting, it is replaced instead of queued again, so a
+stale "Now playing" is never sent after the next one is known.
+"""
+
+import logging
+import time
+
+from collections import deque
+from threading import Thread, Condition
+
+import metrics
+from config import OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, \
+    OUTBOX_SIZE
+
+logger = logging.getLogger('oxo')
+
+# Priority lanes, sent in this order
+REPLY = 0
+AMBIENT = 1
+LANES = (REPLY, AMBIENT)
+
+
+class TokenBucket(object):
+    """Allow `rate` events per second with bursts of up to `burst` events."""
+
+    def __init__(self, rate, burst):
+        """Create a full bucket."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+
+    def _fill(self, now):
+        """Add tokens for the time passed since the last fill."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """Return seconds until a token is available."""
+        self._fill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        """Use up one token."""
+        self._fill(now)
+        self.tokens -= 1
+
+    def block(self, now, seconds):
+        """Empty the bucket for `seconds`, e.g. after a flood error."""
+        self._fill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class Message(object):
+    """A Bot API call waiting in the outbox."""
+
+    def __init__(self, bot, method, chat_id, priority, key, kwargs):
+        """Describe a call of `bot.<method>(chat_id=chat_id, **kwargs)`."""
+        self.bot = bot
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.key = key
+        self.kwargs = kwargs
+        self.created = time.time()
+
+    def __repr__(self):
+        """Show method and chat."""
+        return "<Message {} to {}>".format(self.method, self.chat_id)
+
+    def send(self):
+        """Call the Bot API."""
+        return getattr(self.bot, self.method)(chat_id=self.chat_id, **self.kwargs)
+
+
+class Outbox(Thread):
+    """Send queued messages within per-chat and global rate limits."""
+
+    def __init__(self, global_rate=OUTBOX_GLOBAL_RATE,
+            chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+            size=OUTBOX_SIZE):
+        """Init as daemon thread."""
+        super(Outbox, self).__init__(name="outbox")
+        self.setDaemon(True)
+        self.cond = Condition()
+        self.lanes = {lane: deque() for lane in LANES}
+        self.pending = {}
+        self.size = size
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.flooded = 0
+
+    def __len__(self):
+        """Return the number of waiting messages."""
+        with self.cond:
+            return sum(len(q) for q in self.lanes.values())
+
+    def put(self, bot, method, chat_id, priority=REPLY, key=None, **kwargs):
+        """Queue a Bot API call, replacing a waiting one with the same key.
+
+        If the outbox is full, the oldest ambient message is dropped to make
+        room. Returns False if the message was dropped instead.
+        """
+        msg = Message(bot, method, chat_id, priority, key, kwargs)
+        with self.cond:
+            if not self.is_alive():
+                self.start()
+            if key is not None and key in self.pending:
+                old = self.pending[key]
+                lane = self.lanes[old.priority]
+                lane[lane.index(old)] = msg
+                self.pending[key] = msg
+                self.coalesced += 1
+                logger.debug("Replaced waiting {}".format(old))
+                return True
+
+            if sum(len(q) for q in self.lanes.values()) >= self.size:
+                if len(self.lanes[AMBIENT]) > 0:
+                    self._forget(self.lanes[AMBIENT].popleft())
+                elif priority == AMBIENT:
+                    self.dropped += 1
+                    return False
+                else:
+                    self._forget(self.lanes[REPLY].popleft())
+
+            self.lanes[priority].append(msg)
+            if key is not None:
+                self.pending[key] = msg
+            self.cond.notify()
+        return True
+
+    def _forget(self, msg):
+        """Account for a message dropped from a full outbox."""
+        self.dropped += 1
+        if msg.key is not None:
+            self.pending.pop(msg.key, None)
+        logger.warning("Outbox full, dropped {}".format(msg))
+
+    def send_message(self, bot, chat_id, text, priority=REPLY, key=None,
+            **kwargs):
+        """Queue a text message."""
+        return self.put(bot, "sendMessage", chat_id, priority, key,
+            text=text, **kwargs)
+
+    def send_photo(self, bot, chat_id, photo, priority=REPLY, key=None,
+            **kwargs):
+        """Queue a photo."""
+        return self.put(bot, "sendPhoto", chat_id, priority, key,
+            photo=photo, **kwargs)
+
+    def chat_bucket(self, chat_id):
+        """Return the token bucket of a chat."""
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next(self, now):
+        """Pop the next message that may be sent now.
+
+        Returns the message or None and the seconds to wait before trying
+        again. Messages to a throttled chat don't hold up other chats.
+        """
+        wait = self.global_bucket.delay(now)
+        if wait > 0:
+            return None, wait
+
+        wait = None
+        for lane in LANES:
+            q = self.lanes[lane]
+            blocked = set()
+            for msg in q:
+                if msg.chat_id in blocked:
+                    continue
+                delay = self.chat_bucket(msg.chat_id).delay(now)
+                if delay == 0:
+                    q.remove(msg)
+                    if msg.key is not None and self.pending.get(msg.key) is msg:
+                        del self.pending[msg.key]
+                    self.chat_bucket(msg.chat_id).take(now)
+                    self.global_bucket.take(now)
+                    return msg, 0
+                blocked.add(msg.chat_id)
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def run(self):
+        """Thread target."""
+        while True:
+            with self.cond:
+                msg, wait = self._next(time.time())
+                while msg is None:
+                    self.cond.wait(wait)
+                    msg, wait = self._next(time.time())
+            self.deliver(msg)
+
+    def deliver(self, msg):
+        """Send a message, backing off the chat when Telegram asks to."""
+        try:
+            msg.send()
+            self.sent += 1
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is None:
+                logger.error("Sending {} failed: {}".format(msg, e))
+                return
+            self.flooded += 1
+            logger.warning("Flood limit for chat {}, waiting {}s".format(
+                msg.chat_id, retry_after))
+            with self.cond:
+                self.chat_bucket(msg.chat_id).block(time.time(), retry_after)
+                if msg.key is not None:
+                    if msg.key in self.pending:
+                        # A newer message replaced this one meanwhile
+                        return
+                    self.pending[msg.key] = msg
+                self.lanes[msg.priority].appendleft(msg)
+                self.cond.notify()
+
+    def stats(self):
+        """Return counters of sent, coalesced, dropped and flooded messages."""
+        return {
+            "waiting": len(self),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "flooded": self.flooded
+        }
+
+
+outbox = Outbox()
+
+metrics.gauge("outbox_messages", "Outbound Telegram messages by outcome",
+    outbox.stats, label="state")
@@ -3,7 +3,6 @@
 """Videoplayer and Radio."""
 
 import logging
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from threading import Thread
 
 logger = logging.getLogger('oxo')
@@ -11,6 +10,8 @@ logger = logging.getLogger('oxo')
 
 def inline_keyboard(options):
     """Return an inline Keyboard given a dictionary of callback:display pairs."""
+    # The video player doesn't need telegram, import it when it's used
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     rv = InlineKeyboardMarkup([[InlineKeyboardButton(v, callback_data=k)]
         for k, v in list(options.items())])
     return rv
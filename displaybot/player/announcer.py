@@ -0,0 +1,196 @@
+# coding: utf-8
+
+"""Announce the tracks playing on the radio in subscribed chats."""
+
+import logging
+
+from threading import RLock
+from telegram import ParseMode
+
+from config import db
+from outbox import outbox, AMBIENT
+from player.state import radio_state
+from player.research import researcher
+from player.fip import FipPoller, FIP_STATIONS, titlestr
+
+logger = logging.getLogger('oxo')
+
+
+class Announcer(object):
+    """Fan out title changes of the playing station to subscribed chats.
+
+    There is one source of titles at a time: the fip livemeta poller when a
+    fip station is playing, the stream title in the radio state otherwise.
+    Every title change is sent once to each subscribed chat. Each chat keeps
+    its own marker of the last title sent to it, so chats joining later get
+    the current title and nobody gets the same title twice.
+
+    Subscribed chats and their markers are saved whenever they change, so
+    announcements continue after a restart without repeating the last title.
+    """
+
+    def __init__(self, db):
+        """Create announcer without subscribers."""
+        self.db = db
+        self.lock = RLock()
+        self.bot = None
+        self.chats = {}
+        self.track = None
+        self.fip_poller = None
+        self.listening = False
+
+    def subscribe(self, bot, chat_id):
+        """Announce titles in a chat, starting with the current one."""
+        with self.lock:
+            self.bot = bot
+            self.chats.setdefault(chat_id, None)
+            self.save()
+            self.listen()
+            self.station_changed(radio_state.get("station_playing"))
+            if self.track is not None:
+                self.send(self.track, [chat_id])
+            else:
+                self.title_changed(radio_state.get("station_title"))
+
+    def unsubscribe(self, chat_id):
+        """Stop announcing titles in a chat."""
+        with self.lock:
+            self.chats.pop(chat_id, None)
+            self.save()
+            if len(self.chats) == 0:
+                self.stop_fip()
+
+    def listen(self):
+        """Follow changes of the radio state."""
+        with self.lock:
+            if not self.listening:
+                radio_state.subscribe(self.state_changed)
+                self.listening = True
+
+    def subscribers(self):
+        """Return the ids of subscribed chats."""
+        with self.lock:
+            return list(self.chats.keys())
+
+    def stop_fip(self):
+        """Stop polling fip livemeta."""
+        if self.fip_poller is not None:
+            self.fip_poller.stop()
+            self.fip_poller = None
+
+    def state_changed(self, changed):
+        """Radio state listener."""
+        if "station_playing" in changed:
+            self.station_changed(changed["station_playing"])
+        if "station_title" in changed:
+            self.title_changed(changed["station_title"])
+
+    def station_changed(self, station):
+        """Switch the source of titles to the station that is playing."""
+        with self.lock:
+            poller = self.fip_poller
+            if poller is not None and poller.station == station \
+                    and poller.is_alive():
+                return
+            if poller is None and self.track is not None \
+                    and self.track.get("station") == station:
+                return
+
+            self.stop_fip()
+            self.track = None
+            if station in FIP_STATIONS and len(self.chats) > 0:
+                logger.info("Starting fip api title crawler...")
+                self.fip_poller = FipPoller(station, self.fip_title_changed)
+                self.fip_poller.start()
+
+    def title_changed(self, title):
+        """Announce a stream title of a station other than fip."""
+        station = radio_state.get("station_playing")
+        if station in FIP_STATIONS or not title:
+            return
+        track = {
+            "id": title,
+            "station": station,
+            "text": "▶️ Now playing {}".format(title),
+            "markdown": False,
+            "research": title[:title.find(" - ")] if " - " in title else None,
+            "image": None
+        }
+        self.publish(track)
+
+    def fip_title_changed(self, current):
+        """Announce a track reported by the fip poller."""
+        track = {
+            "id": titlestr(current),
+            "station": radio_state.get("station_playing"),
+            "text": "▶️ Now playing {artist} – _{title}_ \nfrom {album}".format(
+                title=current["title"],
+                artist=current["artist"],
+                album=current["album"]),
+            "markdown": True,
+            "research": current["artist"],
+            "image": current["image"]
+        }
+        self.publish(track)
+
+    def publish(self, track):
+        """Make track the current one and send it to all chats."""
+        with self.lock:
+            self.track = track
+            chat_ids = list(self.chats.keys())
+        logger.debug("Announcing '{}' in {} chats".format(
+            track["id"], len(chat_ids)))
+        self.send(track, chat_ids)
+
+    def send(self, track, chat_ids):
+        """Send track to chats that haven't seen it yet."""
+        with self.lock:
+            bot = self.bot
+            chat_ids = [c for c in chat_ids
+                if c in self.chats and self.chats[c] != track["id"]]
+            for chat_id in chat_ids:
+                self.chats[chat_id] = track["id"]
+            if len(chat_ids) > 0:
+                self.save()
+        if bot is None or len(chat_ids) == 0:
+            return
+
+        kwargs = {}
+        if track["markdown"]:
+            kwargs = {"disable_notification": True,
+                "parse_mode": ParseMode.MARKDOWN}
+        for chat_id in chat_ids:
+            outbox.send_message(bot, chat_id, track["text"],
+                priority=AMBIENT, key=("title", chat_id), **kwargs)
+
+        if track["research"]:
+            researcher.submit(track["research"], bot, chat_ids,
+                image_url=track["image"])
+        else:
+            logger.debug("Not compiling research for this title")
+
+    #
+    # Resume
+    #
+
+    def save(self):
+        """Persist subscribed chats with the last title sent to each."""
+        with self.lock:
+            chats = list(self.chats.items())
+        self.db.save_snapshot("announcer", {"chats": chats})
+
+    def restore(self, bot):
+        """Resubscribe the chats of the saved snapshot."""
+        data = self.db.snapshot("announcer")
+        if data is None or len(data["chats"]) == 0:
+            return
+        with self.lock:
+            self.bot = bot
+            self.chats = {chat_id: marker for chat_id, marker in data["chats"]}
+            self.listen()
+            self.station_changed(radio_state.get("station_playing"))
+        logger.info("Resuming title announcements in {} chats".format(
+            len(self.chats)))
+
+
+announcer = Announcer(db)
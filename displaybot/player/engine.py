@@ -0,0 +1,147 @@
+# coding: utf-8
+
+"""Long-lived mplayer process controlled through slave mode."""
+
+import logging
+
+from collections import deque
+from queue import Queue
+from threading import Thread, Event, Lock
+from time import time
+from sh import mplayer
+
+import metrics
+
+logger = logging.getLogger('oxo')
+
+# mplayer prints this when audio output starts
+START_PLAYBACK = "Starting playback..."
+
+station_switch_seconds = metrics.histogram("station_switch_seconds",
+    "Time from loading a station to the first audio")
+mplayer_restarts = metrics.counter("mplayer_restarts_total",
+    "Restarts of the radio mplayer process")
+
+
+class MplayerEngine(object):
+    """Play radio stations in a single mplayer running in `-slave -idle` mode.
+
+    Stations are switched by writing `loadfile` commands to mplayer's stdin
+    instead of starting a new process, which saves process startup and codec
+    initialization. A supervisor thread restarts mplayer with exponential
+    backoff if it dies and reloads the station that was playing.
+
+    `on_line(line, stdin)` is called with every line mplayer prints.
+    """
+
+    def __init__(self, on_line=None):
+        """Create engine, mplayer is started with `start`."""
+        self.on_line = on_line
+        self.process = None
+        self.stdin = None
+        self.url = None
+        self.lock = Lock()
+        self.stopped = Event()
+        self.supervisor = None
+        self.restarts = 0
+        self.switch_started = None
+        self.first_audio_times = deque(maxlen=100)
+
+    def start(self):
+        """Start mplayer and the supervisor thread."""
+        self.stopped.clear()
+        self._spawn()
+        self.supervisor = Thread(target=self.supervise, name="mplayer-supervisor")
+        self.supervisor.setDaemon(True)
+        self.supervisor.start()
+
+    def _spawn(self):
+        """Start a new mplayer process."""
+        self.stdin = Queue()
+        self.process = mplayer("-slave", "-idle", "-quiet", "-nolirc",
+            _bg=True,
+            _in=self.stdin,
+            _out=self.output,
+            _ok_code=[0, 1])
+        logger.debug("Started mplayer {}".format(self.process.pid))
+
+    def supervise(self):
+        """Restart mplayer with backoff whenever it exits."""
+        delay = 1.0
+        while not self.stopped.is_set():
+            t0 = time()
+            try:
+                self.process.wait()
+            except Exception as e:
+                logger.debug("mplayer exited: {}".format(e))
+            if self.stopped.is_set():
+                break
+
+            # Reset backoff if mplayer ran for a while
+            if time() - t0 > 60:
+                delay = 1.0
+            logger.warning("mplayer died, restarting in {:.0f}s".format(delay))
+            if self.stopped.wait(delay):
+                break
+            delay = min(delay * 2, 60.0)
+
+            with self.lock:
+                self.restarts += 1
+                mplayer_restarts.inc()
+                try:
+                    self._spawn()
+                    if self.url is not None:
+                        self._load(self.url)
+                except Exception as e:
+                    # Waiting on the old process returns at once, so this
+                    # is retried after the next, longer delay
+                    logger.error("Could not restart mplayer: {}".format(e),
+                        exc_info=True)
+
+    def output(self, line):
+        """Handle a line of mplayer output."""
+        if START_PLAYBACK in line and self.switch_started is not None:
+            latency = time() - self.switch_started
+            self.switch_started = None
+            self.first_audio_times.append(latency)
+            station_switch_seconds.observe(latency)
+            logger.info("Time to first audio {:.2f}s".format(latency))
+        if self.on_line is not None:
+            self.on_line(line, self.stdin)
+
+    def _load(self, url):
+        """Send a loadfile command."""
+        self.switch_started = time()
+        self.stdin.put("loadfile \"{}\" 0\n".format(url))
+
+    def play(self, url):
+        """Switch to a station url, or stop playback if url is None."""
+        with self.lock:
+            self.url = url
+            if url is None:
+                self.switch_started = None
+                self.stdin.put("stop\n")
+            else:
+                self._load(url)
+
+    def terminate(self):
+        """Quit mplayer and stop supervising it."""
+        self.stopped.set()
+        with self.lock:
+            if self.process is not None:
+                self.stdin.put("quit\n")
+                try:
+                    self.process.terminate()
+                except OSError:
+                    pass
+
+    def time_to_first_audio(self):
+        """Return last, mean and max time to first audio in seconds."""
+        if len(self.first_audio_times) == 0:
+            return None
+        return {
+            "last": self.first_audio_times[-1],
+            "mean": sum(self.first_audio_times) / len(self.first_audio_times),
+            "max": max(self.first_audio_times),
+            "count": len(self.first_audio_times)
+        }
@@ -0,0 +1,136 @@
+# coding: utf-8
+
+"""Track metadata for fip stations from the fip livemeta api."""
+
+import logging
+import time
+
+from random import uniform
+from threading import Thread, Event
+
+import net
+from config import FIP_POLL_MIN, FIP_POLL_MAX
+from player.state import radio_state
+
+logger = logging.getLogger('oxo')
+
+FIP_STATIONS = {
+    "fip": 7,
+    "fip du groove": 66,
+    "fip du jazz": 65,
+    "fip du monde": 69,
+    "fip du reggae": 71,
+    "fip du rock": 64,
+    "fip tout nouveau": 70
+}
+
+LIVEMETA_URL = "http://www.fipradio.fr/livemeta/{}"
+
+
+def parse(data):
+    """Return current track info and the time it ends from livemeta data.
+
+    Returns (None, None) if the data contains no current track.
+    """
+    if "levels" not in data or len(data["levels"]) == 0:
+        logger.warning("No data found in fip livemeta:\n\n{}".format(data))
+        return None, None
+
+    # fip, y u no flat data
+    position = data["levels"][0]["position"]
+    item_id = data["levels"][0]['items'][position]
+    item = data["steps"][item_id]
+
+    current = {
+        "artist": item["authors"].title() if "authors" in item else None,
+        "performer": item["performers"].title() if "performers" in item else None,
+        "title": item["title"].title() if "title" in item else None,
+        "album": item["titreAlbum"].title() if "titreAlbum" in item else None,
+        "label": item["label"].title() if "label" in item else None,
+        "image": item.get("visual")
+    }
+    return current, item.get("end")
+
+
+def titlestr(t):
+    """Return a string identifying a track."""
+    if t:
+        return "{} - {} ({})".format(
+            t["artist"], t["title"], t["album"])
+    else:
+        return None
+
+
+class FipPoller(Thread):
+    """Poll the current track of a fip station.
+
+    Instead of polling at a fixed interval, the poller sleeps until the
+    current track is scheduled to end, plus some jitter, bounded by
+    FIP_POLL_MIN and FIP_POLL_MAX. Requests are conditional when the server
+    sends ETag or Last-Modified headers. `callback(current)` is called
+    whenever the track changes.
+    """
+
+    def __init__(self, station, callback):
+        """Init as daemon thread polling the given station."""
+        super(FipPoller, self).__init__(name="fip-{}".format(station))
+        self.setDaemon(True)
+        self.station = station
+        self.url = LIVEMETA_URL.format(FIP_STATIONS[station])
+        self.callback = callback
+        self.current = None
+        self.data = None
+        self.etag = None
+        self.modified = None
+        self.stopped = False
+        self.wake = Event()
+
+    def stop(self):
+        """Stop polling."""
+        self.stopped = True
+        self.wake.set()
+
+    def run(self):
+        """Thread target."""
+        while not self.stopped:
+            if radio_state.get("station_playing") != self.station:
+                logger.debug("Station changed, stopping fip poller")
+                break
+
+            try:
+                delay = self.poll()
+            except Exception as e:
+                logger.error("Fip livemeta request failed: {}".format(e))
+                delay = FIP_POLL_MIN
+
+            logger.debug("Next fip livemeta request in {:.0f}s".format(delay))
+            self.wake.wait(delay)
+
+    def poll(self):
+        """Request livemeta, announce track changes and return the delay."""
+        logger.debug("Requesting fip current track")
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.modified:
+            headers["If-Modified-Since"] = self.modified
+
+        req = net.get(self.url, headers=headers)
+        if req.status_code != 304:
+            req.raise_for_status()
+            self.data = req.json()
+            self.etag = req.headers.get("ETag")
+            self.modified = req.headers.get("Last-Modified")
+
+        current, end = parse(self.data or {})
+        if current is not None and titlestr(current) != titlestr(self.current):
+            logger.debug("Title changed from '{}' to '{}'".format(
+                titlestr(self.current), titlestr(current)))
+            self.current = current
+            if not self.stopped:
+                self.callback(current)
+
+        if end is None:
+            return FIP_POLL_MIN
+        delay = end - time.time() + uniform(1.0, 3.0)
+        return min(max(delay, FIP_POLL_MIN), FIP_POLL_MAX)
@@ -0,0 +1,134 @@
+# coding: utf-8
+
+"""Read track titles from the ICY metadata of a radio stream.
+
+Shoutcast and Icecast servers interleave the audio with metadata blocks when
+the client sends `Icy-MetaData: 1`. After every `icy-metaint` bytes of audio
+follows one length byte and `length * 16` bytes of metadata such as
+`StreamTitle='Artist - Title';StreamUrl='';`, padded with NUL bytes.
+
+Shoutcast servers answer with an `ICY 200 OK` status line, so the stream is
+opened on a plain socket like the station prober does.
+"""
+
+import logging
+import re
+
+from threading import Thread, Event
+
+from config import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from player.probe import request
+
+logger = logging.getLogger('oxo')
+
+META_RE = re.compile(r"(\w+)='(.*?)';(?=\w+='|\s*$)", re.S)
+
+# Skip audio in reads of this size
+SKIP_SIZE = 64 * 1024
+
+
+def decode(block):
+    """Return metadata bytes as text."""
+    block = block.rstrip(b"\0")
+    try:
+        return block.decode("utf-8")
+    except UnicodeDecodeError:
+        return block.decode("latin-1")
+
+
+def parse_metadata(text):
+    """Return a dict of the key='value'; pairs in ICY metadata."""
+    return dict(META_RE.findall(text.strip()))
+
+
+def read_exactly(f, n):
+    """Read n bytes from f, raising EOFError if the stream ends before."""
+    buf = f.read(n)
+    while len(buf) < n:
+        chunk = f.read(n - len(buf))
+        if not chunk:
+            raise EOFError("Stream ended")
+        buf += chunk
+    return buf
+
+
+def skip(f, n):
+    """Read and discard n bytes from f."""
+    while n > 0:
+        chunk = f.read(min(n, SKIP_SIZE))
+        if not chunk:
+            raise EOFError("Stream ended")
+        n -= len(chunk)
+
+
+def read_titles(f, metaint):
+    """Yield the stream title of every non-empty metadata block in f."""
+    while True:
+        skip(f, metaint)
+        length = read_exactly(f, 1)[0] * 16
+        if length > 0:
+            meta = parse_metadata(decode(read_exactly(f, length)))
+            if "StreamTitle" in meta:
+                yield meta["StreamTitle"]
+
+
+class IcyReader(Thread):
+    """Read titles from a side connection to a radio stream.
+
+    `callback(title)` is called whenever the stream title changes. The
+    connection is reopened with increasing delay when it drops.
+    """
+
+    def __init__(self, url, callback):
+        """Init as daemon thread reading from url."""
+        super(IcyReader, self).__init__(name="icy")
+        self.setDaemon(True)
+        self.url = url
+        self.callback = callback
+        self.title = None
+        self.stopped = False
+        self.wake = Event()
+        self.response = None
+
+    def stop(self):
+        """Close the connection and stop reading."""
+        self.stopped = True
+        self.wake.set()
+        if self.response is not None:
+            self.response.close()
+
+    def run(self):
+        """Thread target."""
+        delay = 1.0
+        while not self.stopped:
+            try:
+                self.read()
+            except Exception as e:
+                if self.stopped:
+                    break
+                logger.debug("ICY connection to {} failed: {}".format(self.url, e))
+            else:
+                break
+            self.wake.wait(delay)
+            delay = min(delay * 2, 60.0)
+
+    def read(self):
+        """Connect and announce titles until the stream ends."""
+        self.response = request(self.url, HTTP_CONNECT_TIMEOUT, metadata=True)
+        self.response.sock.settimeout(HTTP_READ_TIMEOUT)
+        if self.response.status != 200:
+            self.response.close()
+            raise IOError("Station answered {}".format(self.response.status))
+
+        metaint = self.response.headers.get("icy-metaint")
+        if metaint is None:
+            logger.info("Station {} doesn't send ICY metadata".format(self.url))
+            self.response.close()
+            return
+
+        for title in read_titles(self.response.fp, int(metaint)):
+            if self.stopped:
+                break
+            if title and title != self.title:
+                self.title = title
+                self.callback(title)
@@ -0,0 +1,59 @@
+# coding: utf-8
+
+"""Warm clip files into the page cache before they are played."""
+
+import logging
+import os
+
+from queue import Queue
+from threading import Thread
+
+import metrics
+
+logger = logging.getLogger('oxo')
+
+READ_SIZE = 1024 * 1024
+
+
+def warm(fpath):
+    """Ask the kernel to read a file into the page cache.
+
+    Uses fadvise where available and falls back to reading the file.
+    """
+    with open(fpath, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while f.read(READ_SIZE):
+                pass
+
+
+class Prefetcher(Thread):
+    """Background thread warming queued clip files."""
+
+    def __init__(self):
+        """Init as daemon thread."""
+        super(Prefetcher, self).__init__(name="prefetch")
+        self.setDaemon(True)
+        self.queue = Queue()
+
+    def put(self, fpath):
+        """Queue a file to be warmed, starting the thread if necessary."""
+        if not self.is_alive():
+            self.start()
+        self.queue.put(fpath)
+
+    def run(self):
+        """Thread target."""
+        while True:
+            fpath = self.queue.get()
+            try:
+                warm(fpath)
+            except OSError as e:
+                logger.debug("Could not prefetch {}: {}".format(fpath, e))
+
+
+prefetcher = Prefetcher()
+
+metrics.gauge("prefetch_queue_depth", "Clip files waiting to be prefetched",
+    prefetcher.queue.qsize)
@@ -0,0 +1,212 @@
+# coding: utf-8
+
+"""Station health prober."""
+
+import logging
+import socket
+import ssl
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
+from urllib.parse import urlsplit, urljoin
+
+from config import db, STATION_PROBE_INTERVAL, STATION_PROBE_TTL, \
+    STATION_PROBE_TIMEOUT
+
+logger = logging.getLogger('oxo')
+
+MAX_REDIRECTS = 3
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class Response(object):
+    """Status and headers of a stream response, with the body left to read."""
+
+    def __init__(self, sock, fp, status, headers, connect, ttfb):
+        """Store the response of an open connection."""
+        self.sock = sock
+        self.fp = fp
+        self.status = status
+        self.headers = headers
+        self.connect = connect
+        self.ttfb = ttfb
+
+    def close(self):
+        """Close the connection, waking up a thread reading from it."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.fp.close()
+        self.sock.close()
+
+
+def request_head(url, timeout, metadata=False):
+    """Open a stream and return a Response once its headers are read.
+
+    Uses a plain socket because Shoutcast servers answer with an `ICY 200 OK`
+    status line, which HTTP libraries reject. With `metadata`, the server is
+    asked to interleave ICY metadata with the audio.
+    """
+    parts = urlsplit(url)
+    https = parts.scheme == "https"
+    port = parts.port or (443 if https else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    t0 = time.time()
+    sock = socket.create_connection((parts.hostname, port), timeout)
+    try:
+        if https:
+            sock = ssl.create_default_context().wrap_socket(
+                sock, server_hostname=parts.hostname)
+        connect = time.time() - t0
+
+        sock.sendall((
+            "GET {} HTTP/1.0\r\n"
+            "Host: {}\r\n"
+            "User-Agent: displaybot\r\n"
+            "Icy-MetaData: {}\r\n"
+            "\r\n").format(path, parts.netloc, int(metadata)).encode("utf-8"))
+
+        fp = sock.makefile("rb")
+        lines = [fp.readline(MAX_HEADER_SIZE)]
+        ttfb = time.time() - t0
+        size = len(lines[0])
+        while lines[-1].strip() and size < MAX_HEADER_SIZE:
+            lines.append(fp.readline(MAX_HEADER_SIZE - size))
+            size += len(lines[-1])
+    except Exception:
+        sock.close()
+        raise
+
+    lines = [line.decode("latin-1").strip() for line in lines]
+    status = lines[0].split()
+    if len(status) < 2 or not status[1].isdigit():
+        fp.close()
+        sock.close()
+        raise IOError("Invalid status line '{}'".format(lines[0]))
+
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    return Response(sock, fp, int(status[1]), headers, connect, ttfb)
+
+
+def request(url, timeout, metadata=False):
+    """Open a stream like `request_head`, following redirects."""
+    for i in range(MAX_REDIRECTS + 1):
+        response = request_head(url, timeout, metadata)
+        if response.status in (301, 302, 303, 307, 308) \
+                and "location" in response.headers:
+            response.close()
+            url = urljoin(url, response.headers["location"])
+        else:
+            break
+    return response
+
+
+def probe_station(url, timeout=STATION_PROBE_TIMEOUT):
+    """Return a dict describing the health of a station stream."""
+    rv = {"ok": False, "connect": None, "ttfb": None, "bitrate": None,
+        "checked": time.time()}
+    try:
+        response = request(url, timeout)
+    except (OSError, IOError) as e:
+        logger.debug("Probe of {} failed: {}".format(url, e))
+        return rv
+    response.close()
+
+    bitrate = response.headers.get("icy-br", "").split(",")[0]
+    rv.update({
+        "ok": response.status == 200,
+        "connect": response.connect,
+        "ttfb": response.ttfb,
+        "bitrate": int(bitrate) if bitrate.isdigit() else None
+    })
+    return rv
+
+
+class StationProber(Thread):
+    """Periodically probe all stations concurrently and cache the results."""
+
+    def __init__(self):
+        """Init as daemon thread."""
+        super(StationProber, self).__init__(name="station-prober")
+        self.setDaemon(True)
+        self.lock = Lock()
+        self.wake = Event()
+        self.cache = {}
+
+    def refresh(self):
+        """Probe stations now without waiting for the results."""
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+        self.wake.set()
+
+    def run(self):
+        """Thread target."""
+        while True:
+            self.wake.clear()
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.error(e, exc_info=True)
+            self.wake.wait(STATION_PROBE_INTERVAL)
+
+    def probe_all(self):
+        """Probe all stations in parallel."""
+        stations = db.stations()
+        t0 = time.time()
+        with ThreadPoolExecutor(max(len(stations), 1)) as pool:
+            results = pool.map(lambda s: probe_station(s["url"]), stations)
+            results = dict(zip([s["name"] for s in stations], results))
+        with self.lock:
+            self.cache = results
+        logger.debug("Probed {} stations in {:.1f}s, {} dead".format(
+            len(results), time.time() - t0,
+            len([r for r in results.values() if not r["ok"]])))
+
+    def results(self):
+        """Return fresh probe results by station name."""
+        now = time.time()
+        with self.lock:
+            return {name: r for name, r in self.cache.items()
+                if now - r["checked"] < STATION_PROBE_TTL}
+
+
+def station_keyboard_options(names, results):
+    """Return ordered (name, label) pairs for the station keyboard.
+
+    Live stations come first, fastest first, followed by stations that were
+    not probed yet and stations that are down.
+    """
+    def key(name):
+        r = results.get(name)
+        if r is None:
+            return (1, 0, name)
+        elif not r["ok"]:
+            return (2, 0, name)
+        return (0, r["ttfb"], name)
+
+    rv = []
+    for name in sorted(names, key=key):
+        r = results.get(name)
+        if r is None:
+            label = name
+        elif not r["ok"]:
+            label = "✖ {}".format(name)
+        else:
+            label = "{} · {:.0f}ms".format(name, r["ttfb"] * 1000)
+            if r["bitrate"]:
+                label += " · {}k".format(r["bitrate"])
+        rv.append((name, label))
+    return rv
+
+
+prober = StationProber()
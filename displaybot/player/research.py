@@ -0,0 +1,181 @@
+# coding: utf-8
+
+"""Wikipedia research about the artists playing on the radio."""
+
+import logging
+import time
+
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Lock
+from telegram import ParseMode, ChatAction
+
+import metrics
+from config import db, RESEARCH_CACHE_SIZE, RESEARCH_TTL, RESEARCH_NEGATIVE_TTL
+from outbox import outbox, AMBIENT
+
+logger = logging.getLogger('oxo')
+
+
+def normalize(subject):
+    """Return the cache key for a research subject."""
+    return " ".join(subject.lower().split())
+
+
+def lookup(subject):
+    """Return title, summary, url and image of a Wikipedia article or None."""
+    # Slow to import because of BeautifulSoup, so only load it when needed
+    import wikipedia
+    wp_articles = wikipedia.search(subject)
+    logger.debug("WP Articles: {}".format(wp_articles))
+    if len(wp_articles) == 0:
+        logger.debug("No wikipedia articles found.")
+        return None
+
+    for article in wp_articles:
+        try:
+            wp = wikipedia.page(article)
+            break
+        except wikipedia.DisambiguationError:
+            logger.warning("Wikipedia: DisambiguationError for {}".format(article))
+        except wikipedia.PageError:
+            logger.warning("Wikipedia: PageError for {}".format(article))
+    else:
+        logger.warning("Wikipedia articles exhausted")
+        return None
+
+    logger.debug("Wikipedia: {}".format(wp))
+    wp_images = [url for url in wp.images if url.endswith("jpg")]
+    return {
+        "title": wp.title,
+        "summary": wp.summary,
+        "url": wp.url,
+        "image": wp_images[0] if len(wp_images) > 0 else None
+    }
+
+
+class ResearchCache(object):
+    """LRU cache of research results that expire after a time to live.
+
+    Misses are cached as well, with a shorter time to live. The cache is
+    backed by the database, so results survive restarts.
+    """
+
+    def __init__(self, db, size, ttl, negative_ttl):
+        """Create an empty cache."""
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """Return (True, result) for a fresh entry or (False, None)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None:
+            entry = self.db.research(key)
+            if entry is None:
+                return False, None
+            self._put(key, entry)
+
+        result, fetched = entry
+        ttl = self.ttl if result is not None else self.negative_ttl
+        if time.time() - fetched > ttl:
+            return False, None
+        return True, result
+
+    def put(self, key, result):
+        """Store a result, None for a miss."""
+        entry = (result, time.time())
+        self.db.save_research(key, *entry)
+        self._put(key, entry)
+
+    def _put(self, key, entry):
+        """Store an entry in memory, evicting the least recently used."""
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+cache = ResearchCache(db, RESEARCH_CACHE_SIZE, RESEARCH_TTL, RESEARCH_NEGATIVE_TTL)
+
+
+def research(subject):
+    """Return a cached or freshly looked up research result or None."""
+    key = normalize(subject)
+    found, result = cache.get(key)
+    if not found:
+        logger.info("Researching '{}'".format(subject))
+        result = lookup(subject)
+        cache.put(key, result)
+    return result
+
+
+def send(result, bot, chat_id, image_url=None):
+    """Send wikipedia summary and image or supplied image to chat."""
+    msg = "*{}*\n{}\n\n[Wikipedia]({})".format(
+        result["title"], result["summary"], result["url"])
+
+    outbox.send_message(bot, chat_id, msg,
+        priority=AMBIENT,
+        key=("research", chat_id),
+        disable_notification=True,
+        disable_web_page_preview=True,
+        parse_mode=ParseMode.MARKDOWN)
+
+    image_url = image_url or result["image"]
+    if image_url:
+        logger.debug("Sending photo {}".format(image_url))
+        outbox.send_photo(bot, chat_id, image_url,
+            priority=AMBIENT,
+            key=("research-photo", chat_id))
+
+
+class Researcher(Thread):
+    """Background thread answering research requests."""
+
+    def __init__(self):
+        """Init as daemon thread."""
+        super(Researcher, self).__init__(name="research")
+        self.setDaemon(True)
+        self.queue = Queue()
+        self.lock = Lock()
+
+    def submit(self, subject, bot, chat_ids, image_url=None):
+        """Research subject in the background and send the result to chats."""
+        if subject is None:
+            return
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+        self.queue.put((subject, bot, chat_ids, image_url))
+
+    def run(self):
+        """Thread target."""
+        while True:
+            subject, bot, chat_ids, image_url = self.queue.get()
+            try:
+                found, result = cache.get(normalize(subject))
+                if not found:
+                    for chat_id in chat_ids:
+                        outbox.put(bot, "sendChatAction", chat_id,
+                            priority=AMBIENT, key=("typing", chat_id),
+                            action=ChatAction.TYPING)
+                    result = research(subject)
+                if result is not None:
+                    for chat_id in chat_ids:
+                        send(result, bot, chat_id, image_url=image_url)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+
+researcher = Researcher()
+
+metrics.gauge("research_queue_depth", "Subjects waiting to be researched",
+    researcher.queue.qsize)
@@ -0,0 +1,165 @@
+# coding: utf-8
+
+"""Clip scheduler."""
+
+import logging
+
+from random import shuffle
+from threading import Lock
+
+import transcode
+from catalog import catalog
+from config import db, CLIP_DWELL, CLIP_MAX_DWELL
+
+logger = logging.getLogger('oxo')
+
+
+class Scheduler(object):
+    """Select clips to play next and how long to show them.
+
+    Incoming clips are played first. Other clips are drawn from a shuffle bag
+    without replacement, so every clip plays once before any clip repeats.
+    Refilling the bag once it is empty copies and shuffles the catalog, which
+    costs constant time per pick on average, and picks pop from its end.
+
+    The order of the bag is saved by clip id whenever it is refilled, and
+    after each clip only the number of clips left in it, so the position in
+    the bag is restored after a restart.
+    """
+
+    def __init__(self, catalog, db):
+        """Create a scheduler with an empty bag."""
+        self.catalog = catalog
+        self.db = db
+        self.lock = Lock()
+        self.bag = []
+        self.refilled = False
+        self.last = None
+        self.upcoming = None
+
+    def next(self):
+        """Return the next clip to play or None if there are no clips."""
+        clip = self.catalog.pop_incoming()
+        if clip is not None:
+            logger.info("Enqueuing shortlisted clip {}".format(clip["filename"]))
+        elif self.upcoming is not None and self.present(self.upcoming):
+            clip, self.upcoming = self.upcoming, None
+        else:
+            clip = self.draw()
+        self.last = clip
+        return clip
+
+    def peek(self):
+        """Return the clip that `next` will return unless a clip comes in."""
+        if self.upcoming is None or not self.present(self.upcoming):
+            self.upcoming = self.draw()
+        return self.upcoming
+
+    def present(self, clip):
+        """Return True if clip wasn't removed from the catalog."""
+        return self.catalog.get(clip["id"]) is not None
+
+    def playing(self):
+        """Return the current and upcoming clip, which must not be removed."""
+        return [c for c in (self.last, self.upcoming) if c is not None]
+
+    def draw(self):
+        """Draw a clip from the shuffle bag, refilling it when empty.
+
+        Clips removed from the catalog since the bag was filled are skipped.
+        """
+        with self.lock:
+            while len(self.bag) > 0 and not self.present(self.bag[-1]):
+                self.bag.pop()
+            if len(self.bag) == 0:
+                self.bag = self.catalog.all()
+                shuffle(self.bag)
+                self.refilled = True
+                logger.debug("Refilled shuffle bag with {} clips".format(
+                    len(self.bag)))
+                if len(self.bag) == 0:
+                    return None
+
+                # Don't repeat the last clip across a refill
+                if self.bag[-1] is self.last and len(self.bag) > 1:
+                    self.bag[0], self.bag[-1] = self.bag[-1], self.bag[0]
+
+            return self.bag.pop()
+
+    #
+    # Resume
+    #
+
+    def snapshot(self):
+        """Return the current clip and the number of clips left in the bag."""
+        with self.lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        """Return the snapshot, with the lock held."""
+        return {
+            "clip": self.last["id"] if self.last else None,
+            "upcoming": self.upcoming["id"] if self.upcoming else None,
+            "left": len(self.bag)
+        }
+
+    def save(self):
+        """Persist the snapshot, and the bag if it was refilled."""
+        with self.lock:
+            bag = [c["id"] for c in self.bag] if self.refilled else None
+            self.refilled = False
+            data = self._snapshot()
+        if bag is not None:
+            self.db.save_snapshot("scheduler_bag", bag)
+        self.db.save_snapshot("scheduler", data)
+
+    def restore(self):
+        """Continue with the clip and bag position of the saved snapshot.
+
+        The clip that was playing is played again first, followed by the clip
+        that was up next. Clips deleted meanwhile are skipped.
+        """
+        data = self.db.snapshot("scheduler")
+        if data is None:
+            return
+        bag = self.db.snapshot("scheduler_bag") or []
+        with self.lock:
+            ids = bag[:data.get("left", 0)]
+            self.bag = [c for c in map(self.catalog.get, ids) if c is not None]
+
+            upcoming = self.catalog.get(data["upcoming"]) \
+                if data["upcoming"] is not None else None
+            if upcoming is not None:
+                self.bag.append(upcoming)
+            if data["clip"] is not None:
+                self.upcoming = self.catalog.get(data["clip"])
+
+            # Save the bag as restored, without the clips deleted meanwhile
+            self.refilled = True
+        logger.info("Resuming clips with {} left in the shuffle bag".format(
+            len(self.bag)))
+
+    def dwell(self, clip):
+        """Return how many seconds a clip should be shown.
+
+        Probes the clip once if its duration is not known yet.
+        """
+        if clip.get("duration") is None:
+            try:
+                duration, frames = transcode.probe(self.catalog.filepath(clip))
+            except Exception as e:
+                logger.warning("Could not probe clip {}: {}".format(
+                    clip["filename"], e))
+                duration, frames = 0.0, None
+            self.catalog.update(clip, duration=duration or 0.0, frames=frames)
+
+        duration = clip["duration"]
+        if duration <= 0:
+            return CLIP_DWELL
+        elif duration > CLIP_DWELL:
+            return min(duration, CLIP_MAX_DWELL)
+        else:
+            return duration * int(CLIP_DWELL // duration)
+
+
+scheduler = Scheduler(catalog, db)
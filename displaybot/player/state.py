@@ -0,0 +1,97 @@
+# coding: utf-8
+
+"""Radio state."""
+
+import logging
+
+from threading import Condition
+
+import metrics
+from config import db
+
+logger = logging.getLogger('oxo')
+
+state_write_seconds = metrics.histogram("radio_state_write_seconds",
+    "Time to persist a radio state change")
+
+
+class RadioState(object):
+    """Radio state held in memory with change notifications.
+
+    The state is read from the database once. Updates are persisted only when
+    a value actually changes, after which waiting threads are woken up and
+    subscribed callbacks are called with a dict of the changed values.
+    """
+
+    def __init__(self, db):
+        """Create state backed by the radio row in `db`."""
+        self.db = db
+        self.condition = Condition()
+        self.values = {}
+        self.listeners = []
+        self.version = 0
+        self.loaded = False
+
+    def load(self):
+        """Read the radio row from the database."""
+        with self.condition:
+            if not self.loaded:
+                self.values = self.db.radio() or {}
+                self.loaded = True
+
+    def get(self, key, default=None):
+        """Return a state value."""
+        self.load()
+        return self.values.get(key, default)
+
+    def update(self, **changes):
+        """Set state values, persisting and notifying only actual changes."""
+        self.load()
+        with self.condition:
+            changed = {k: v for k, v in changes.items()
+                if self.values.get(k) != v}
+            if len(changed) == 0:
+                return changed
+
+            self.values.update(changed)
+            with state_write_seconds.time():
+                self.db.update_radio(**changed)
+            self.version += 1
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+
+        for callback in listeners:
+            try:
+                callback(changed)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+        return changed
+
+    def notify(self):
+        """Wake up waiting threads without changing any value."""
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout=None):
+        """Block until the state version differs from `version`.
+
+        Returns the current version.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def subscribe(self, callback):
+        """Call `callback(changed)` after every change."""
+        with self.condition:
+            self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        """Remove a callback added with `subscribe`."""
+        with self.condition:
+            if callback in self.listeners:
+                self.listeners.remove(callback)
+
+
+radio_state = RadioState(db)
@@ -5,33 +5,80 @@
 import logging
 import os
 
-from sh import mplayer, ErrorReturnCode_1
-from random import choice
-from config import db, DATA_DIR
+import metrics
+
+from catalog import catalog
 from omxplayer.player import OMXPlayer
 from player import Player
-from tinydb import Query
-from time import sleep
+from player.prefetch import prefetcher
+from player.scheduler import scheduler
+from config import VIDEO_DOUBLE_BUFFER
+from collections import deque
+from time import sleep, time
 from platform import machine
-from json.decoder import JSONDecodeError
 
 logger = logging.getLogger("oxo")
 
+# Players alternate between these names on D-Bus in double buffered mode
+DBUS_NAMES = [
+    'org.mpris.MediaPlayer2.omxplayer1',
+    'org.mpris.MediaPlayer2.omxplayer2'
+]
+
+# Give up measuring a clip switch after this many seconds
+SWITCH_TIMEOUT = 5.0
+
+clip_switch_seconds = metrics.histogram("clip_switch_seconds",
+    "Time from loading a clip until it plays")
+next_clip_seconds = metrics.histogram("next_clip_seconds",
+    "Time to select the next clip")
+clips_played = metrics.counter("clips_played_total", "Clips shown")
+first_frame_seconds = metrics.gauge("first_frame_seconds",
+    "Time from process start to the first clip on screen")
+
 
 class Video(Player):
     """Video player class."""
 
-    def __init__(self):
-        """Init as Player."""
+    def __init__(self, started=None):
+        """Init as Player, `started` is the time the process started."""
         super(Video, self).__init__()
+        self.started = started
         self.logger = logging.getLogger("oxo")
         self.close_player = False
         self.stopped = False
+        self.standby = None
+        self.standby_path = None
+        self.layer = 0
+        self.switch_times = deque(maxlen=100)
 
     @classmethod
     def filepath(cls, clip):
         """Return disk location of a clip."""
-        return os.path.join(DATA_DIR, "clips", clip["filename"])
+        return catalog.filepath(clip)
+
+    @classmethod
+    def player_args(cls, layer=None, alpha=None):
+        """Return command line arguments for omxplayer."""
+        if machine() == "armv7l":
+            rv = [
+                '--blank',
+                '-o', 'hdmi',
+                '--loop',
+                '--no-osd',
+                '--aspect-mode', 'fill',
+                '--win', "'0, 0, 810, 540'"
+            ]
+        else:
+            rv = [
+                '-b',
+                '--loop'
+            ]
+        if layer is not None:
+            rv += ['--layer', str(layer)]
+        if alpha is not None:
+            rv += ['--alpha', str(alpha)]
+        return rv
 
     def run(self):
         """Thread target."""
@@ -45,32 +92,108 @@ class Video(Player):
                     current_clip["filename"][:6]))
 
                 full_path = self.filepath(current_clip)
-
-                if machine() == "armv7l":
-                    player_args = [
-                        '--blank',
-                        '-o', 'hdmi',
-                        '--loop',
-                        '--no-osd',
-                        '--aspect-mode', 'fill',
-                        '--win', "'0, 0, 810, 540'"
-                    ]
+                if not os.path.exists(full_path):
+                    self.logger.warning("Skipping missing clip file {}".format(
+                        full_path))
+                    sleep(1)
+                    continue
+
+                t0 = time()
+                if VIDEO_DOUBLE_BUFFER:
+                    self.swap(full_path)
+                elif self.player is None:
+                    self.player = OMXPlayer(full_path, self.player_args())
                 else:
-                    player_args = [
-                        '-b',
-                        '--loop'
-                    ]
-
-                if self.player is None:
-                    self.player = OMXPlayer(full_path, player_args)
-                else:
-                    self.player.load(full_path, player_args)
+                    self.player.load(full_path, self.player_args())
                     self.player.play()
-
-                sleep(5)
-                self.player.pause()
+                clips_played.inc()
+                catalog.played(current_clip)
+                self.record_switch(t0)
+                if self.started is not None:
+                    self.record_first_frame()
+
+                # Warm the next clip while this one plays
+                upcoming = scheduler.peek()
+                if upcoming is not None:
+                    prefetcher.put(self.filepath(upcoming))
+                    if VIDEO_DOUBLE_BUFFER:
+                        self.preload(self.filepath(upcoming))
+                scheduler.save()
+
+                sleep(scheduler.dwell(current_clip))
+                if not VIDEO_DOUBLE_BUFFER:
+                    self.player.pause()
         self.logger.debug("Exit video player")
 
+    #
+    # Double buffering
+    #
+
+    def preload(self, path):
+        """Load a clip paused and transparent in the standby player.
+
+        The standby player is on the layer above the active one, it stays
+        invisible until it is shown by `swap`.
+        """
+        if self.standby is not None:
+            if self.standby_path == path:
+                return
+            self.standby.quit()
+
+        self.layer += 1
+        self.standby = OMXPlayer(path, self.player_args(self.layer, alpha=0),
+            dbus_name=DBUS_NAMES[self.layer % 2], pause=True)
+        self.standby_path = path
+
+    def swap(self, path):
+        """Show a clip by starting the standby player on top of the active one."""
+        if self.standby is None or self.standby_path != path:
+            self.preload(path)
+
+        previous = self.player
+        self.player, self.standby, self.standby_path = self.standby, None, None
+        self.player.set_alpha(255)
+        self.player.play()
+        if previous is not None:
+            previous.quit()
+
+    #
+    # Switch latency
+    #
+
+    def record_switch(self, t0):
+        """Wait until the player shows the new clip and record how long it took."""
+        deadline = t0 + SWITCH_TIMEOUT
+        try:
+            while self.player.position() <= 0 and time() < deadline:
+                sleep(0.01)
+        except Exception as e:
+            self.logger.debug("Could not read player position: {}".format(e))
+            return
+
+        latency = time() - t0
+        self.switch_times.append(latency)
+        clip_switch_seconds.observe(latency)
+        self.logger.debug("Clip switch took {:.0f}ms".format(latency * 1000))
+
+    def record_first_frame(self):
+        """Log how long it took from process start to the first clip."""
+        elapsed = time() - self.started
+        self.started = None
+        first_frame_seconds.set(elapsed)
+        self.logger.info("First frame {:.2f}s after start".format(elapsed))
+
+    def switch_latency(self):
+        """Return last, mean and max clip switch latency in seconds."""
+        if len(self.switch_times) == 0:
+            return None
+        return {
+            "last": self.switch_times[-1],
+            "mean": sum(self.switch_times) / len(self.switch_times),
+            "max": max(self.switch_times),
+            "count": len(self.switch_times)
+        }
+
     @classmethod
     def interact(cls, line, stdin):
         """Enqueue clips continuously through mplayer STDIN."""
@@ -86,27 +209,16 @@ class Video(Player):
 
     @classmethod
     def get_next(cls):
-        """Select recently added video or a random one from db."""
-        q = Query()
-        q_incoming = db.search(q.incoming == True)
-        if len(q_incoming) > 0:
-            rv = q_incoming[0]
-            db.update({"incoming": False}, q.incoming == True)
-            logger.info("Enqueuing shortlisted clip {}".format(rv["filename"]))
-        else:
-            q = Query()
-            try:
-                q_clips = db.search(q.type == "clip")
-            except JSONDecodeError:
-                rv = None
-            else:
-                rv = choice(q_clips) if len(q_clips) > 0 else None
-        return rv
+        """Select recently added video or the next one from the shuffle bag."""
+        with next_clip_seconds.time():
+            return scheduler.next()
 
     def stop(self):
         """Quit omxplayer instance."""
         self.logger.debug("Stopping {} player...".format(self.__class__.__name__))
         self.stopped = True
+        if self.standby is not None:
+            self.standby.quit()
         if self.running:
             self.player.quit()
             self.logger.info("{} stopped".format(self.__class__.__name__))
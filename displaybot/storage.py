@@ -0,0 +1,369 @@
+# coding: utf-8
+
+"""SQLite storage for clips, stations and radio state."""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from threading import local
+
+logger = logging.getLogger('oxo')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    id INTEGER PRIMARY KEY,
+    url TEXT,
+    author TEXT,
+    filename TEXT NOT NULL,
+    created TEXT,
+    incoming INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS clips_url ON clips (url);
+CREATE INDEX IF NOT EXISTS clips_incoming ON clips (incoming) WHERE incoming = 1;
+
+CREATE TABLE IF NOT EXISTS stations (
+    name TEXT PRIMARY KEY,
+    url TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS radio (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    station_playing TEXT,
+    station_playing_sent TEXT,
+    station_title TEXT,
+    station_title_sent TEXT
+);
+"""
+
+# Schema changes, applied in order to databases created with an older schema.
+# The index of the last applied migration + 1 is stored as `user_version`.
+MIGRATIONS = [
+    # Content addressed clips and url aliases
+    """
+    ALTER TABLE clips ADD COLUMN content_hash TEXT;
+    CREATE INDEX clips_content_hash ON clips (content_hash);
+    CREATE TABLE clip_urls (
+        url TEXT PRIMARY KEY,
+        clip_id INTEGER NOT NULL REFERENCES clips (id) ON DELETE CASCADE
+    );
+    """,
+
+    # Perceptual fingerprints
+    """
+    ALTER TABLE clips ADD COLUMN fingerprint TEXT;
+    """,
+
+    # Normalized variants for hardware decoding
+    """
+    ALTER TABLE clips ADD COLUMN variant TEXT;
+    """,
+
+    # Clip length for scheduling
+    """
+    ALTER TABLE clips ADD COLUMN duration REAL;
+    ALTER TABLE clips ADD COLUMN frames INTEGER;
+    """,
+
+    # Cached Wikipedia research, result is NULL for misses
+    """
+    CREATE TABLE research (
+        subject TEXT PRIMARY KEY,
+        result TEXT,
+        fetched REAL NOT NULL
+    );
+    """,
+
+    # Player state for resuming after a restart
+    """
+    CREATE TABLE snapshots (
+        name TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        saved REAL NOT NULL
+    );
+    """,
+
+    # Disk usage and plays for evicting clips
+    """
+    ALTER TABLE clips ADD COLUMN size INTEGER;
+    ALTER TABLE clips ADD COLUMN last_played REAL;
+    ALTER TABLE clips ADD COLUMN play_count INTEGER NOT NULL DEFAULT 0;
+    """,
+
+    # Clip file lookups for cleaning up the clips directory
+    """
+    CREATE INDEX clips_filename ON clips (filename);
+    CREATE INDEX clips_variant ON clips (variant);
+    """,
+]
+
+CLIP_FIELDS = ("url", "author", "filename", "created", "incoming",
+    "content_hash", "fingerprint", "variant", "duration", "frames", "size")
+INSERT_CLIP = "INSERT INTO clips ({}) VALUES ({})".format(
+    ", ".join(CLIP_FIELDS), ", ".join("?" for k in CLIP_FIELDS))
+
+RADIO_FIELDS = ("station_playing", "station_playing_sent",
+    "station_title", "station_title_sent")
+
+
+class Storage(object):
+    """SQLite database in WAL mode with one connection per thread.
+
+    WAL mode lets the bot, video and radio threads read while another thread
+    writes. Every write is a single row operation or a short transaction.
+    """
+
+    def __init__(self, path):
+        """Store database path, connections are opened lazily."""
+        self.path = path
+        self.local = local()
+
+    @property
+    def connection(self):
+        """Return the sqlite connection of the current thread."""
+        conn = getattr(self.local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self.local.connection = conn
+        return conn
+
+    def execute(self, sql, params=()):
+        """Execute a single statement and return the cursor."""
+        return self.connection.execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """Run several statements in one write transaction.
+
+        A transaction started inside another one is part of the outer one.
+        """
+        conn = self.connection
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def create(self):
+        """Create tables and indexes and apply pending migrations."""
+        conn = self.connection
+        conn.executescript(SCHEMA)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            logger.info("Migrating database to version {}".format(i + 1))
+            conn.executescript("BEGIN; {} PRAGMA user_version = {}; COMMIT;".format(
+                MIGRATIONS[i], i + 1))
+
+    #
+    # Clips
+    #
+
+    @classmethod
+    def clip_row(cls, row):
+        """Return a clip dict for a database row."""
+        clip = dict(row)
+        clip["incoming"] = bool(clip["incoming"])
+        return clip
+
+    @classmethod
+    def clip_values(cls, clip):
+        """Return insert parameters for a clip dict."""
+        return [bool(clip.get(k)) if k == "incoming" else clip.get(k)
+            for k in CLIP_FIELDS]
+
+    def clips(self, after=0):
+        """Return all clips, or those with an id greater than `after`."""
+        return [self.clip_row(row) for row in self.execute(
+            "SELECT * FROM clips WHERE id > ? ORDER BY id", (after, ))]
+
+    def count_clips(self):
+        """Return number of clips."""
+        return self.execute("SELECT COUNT(*) FROM clips").fetchone()[0]
+
+    def insert_clip(self, clip):
+        """Insert a clip dict and return its id."""
+        cur = self.execute(INSERT_CLIP, self.clip_values(clip))
+        return cur.lastrowid
+
+    def insert_clips(self, clips):
+        """Insert many clip dicts in one transaction and return their ids."""
+        with self.transaction() as conn:
+            return [conn.execute(INSERT_CLIP, self.clip_values(clip)).lastrowid
+                for clip in clips]
+
+    def update_clip(self, clip_id, **fields):
+        """Update columns of a single clip."""
+        assignments = ", ".join("{} = ?".format(k) for k in fields)
+        self.execute("UPDATE clips SET {} WHERE id = ?".format(assignments),
+            list(fields.values()) + [clip_id])
+
+    def delete_clips(self, clip_ids):
+        """Delete many clips and their url aliases in one transaction."""
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM clips WHERE id = ?",
+                [(clip_id, ) for clip_id in clip_ids])
+
+    def clips_with_files(self, names):
+        """Return clips whose original or variant has one of the file names."""
+        names = list(names)
+        rv = []
+        for i in range(0, len(names), 500):
+            batch = names[i:i + 500]
+            marks = ", ".join("?" for name in batch)
+            rv.extend(self.clip_row(row) for row in self.execute(
+                "SELECT * FROM clips WHERE filename IN ({0}) "
+                "OR variant IN ({0})".format(marks), batch + batch))
+        return rv
+
+    def clip_urls(self, after=0):
+        """Return (url, clip_id) pairs of url aliases of clips after an id."""
+        return self.execute("SELECT url, clip_id FROM clip_urls "
+            "WHERE clip_id > ?", (after, )).fetchall()
+
+    def insert_clip_url(self, url, clip_id):
+        """Record another url under which a clip was posted."""
+        self.execute(
+            "INSERT OR IGNORE INTO clip_urls (url, clip_id) VALUES (?, ?)",
+            (url, clip_id))
+
+    #
+    # Stations
+    #
+
+    def stations(self):
+        """Return all stations ordered by name."""
+        return [dict(row) for row in self.execute(
+            "SELECT * FROM stations ORDER BY name")]
+
+    def station(self, name):
+        """Return station with the given name or None."""
+        row = self.execute(
+            "SELECT * FROM stations WHERE name = ?", (name, )).fetchone()
+        return dict(row) if row is not None else None
+
+    def count_stations(self):
+        """Return number of stations."""
+        return self.execute("SELECT COUNT(*) FROM stations").fetchone()[0]
+
+    def insert_stations(self, stations):
+        """Insert or replace stations from a dict of name:url pairs."""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO stations (name, url) VALUES (?, ?)",
+                list(stations.items()))
+
+    #
+    # Radio state
+    #
+
+    def radio(self):
+        """Return the radio state or None if it was not set up."""
+        row = self.execute("SELECT * FROM radio WHERE id = 1").fetchone()
+        if row is None:
+            return None
+        rv = dict(row)
+        del rv["id"]
+        return rv
+
+    def insert_radio(self, **fields):
+        """Create the radio state row."""
+        values = [fields.get(k) for k in RADIO_FIELDS]
+        self.execute(
+            "INSERT OR REPLACE INTO radio (id, {}) VALUES (1, ?, ?, ?, ?)".format(
+                ", ".join(RADIO_FIELDS)), values)
+
+    def update_radio(self, **fields):
+        """Update columns of the radio state."""
+        assignments = ", ".join("{} = ?".format(k) for k in fields)
+        self.execute("UPDATE radio SET {} WHERE id = 1".format(assignments),
+            list(fields.values()))
+
+    #
+    # Research cache
+    #
+
+    def research(self, subject):
+        """Return cached (result, fetched) for a subject or None."""
+        row = self.execute(
+            "SELECT result, fetched FROM research WHERE subject = ?",
+            (subject, )).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row["result"]) if row["result"] else None
+        return result, row["fetched"]
+
+    def save_research(self, subject, result, fetched):
+        """Cache a research result, None for a miss."""
+        self.execute(
+            "INSERT OR REPLACE INTO research (subject, result, fetched) "
+            "VALUES (?, ?, ?)",
+            (subject, json.dumps(result) if result else None, fetched))
+
+    #
+    # Snapshots
+    #
+
+    def snapshot(self, name):
+        """Return the data of a saved snapshot or None."""
+        row = self.execute("SELECT data FROM snapshots WHERE name = ?",
+            (name, )).fetchone()
+        return json.loads(row["data"]) if row is not None else None
+
+    def save_snapshot(self, name, data):
+        """Save json serializable data as a snapshot."""
+        self.execute(
+            "INSERT OR REPLACE INTO snapshots (name, data, saved) "
+            "VALUES (?, ?, ?)",
+            (name, json.dumps(data, separators=(",", ":")), time.time()))
+
+    #
+    # Migration
+    #
+
+    def migrate_tinydb(self, fpath):
+        """Import all records of a TinyDB `database.json` file.
+
+        Returns True if a radio state was found in the file.
+        """
+        with open(fpath) as f:
+            data = json.load(f)
+
+        records = list(data.get("_default", {}).items())
+        records.sort(key=lambda item: int(item[0]))
+        records = [record for eid, record in records]
+
+        clips = [r for r in records if r.get("type") == "clip"]
+        stations = {r["name"]: r["url"] for r in records
+            if r.get("type") == "station"}
+        radio = [r for r in records if r.get("type") == "radio"]
+
+        self.insert_clips(clips)
+        self.insert_stations(stations)
+        if len(radio) > 0:
+            self.insert_radio(**radio[0])
+
+        logger.info("Migrated {} clips and {} stations from {}".format(
+            len(clips), len(stations), fpath))
+        return len(radio) > 0
+
+    def import_data_json(self, fpath):
+        """Import clips from the legacy `data.json` file."""
+        with open(fpath) as f:
+            data = json.load(f)
+        for clip in data["clips"]:
+            logger.info("Adding old clip {}".format(clip))
+        self.insert_clips(data["clips"])
+        logger.warning("Please delete {}".format(os.path.basename(fpath)))
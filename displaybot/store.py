@@ -0,0 +1,241 @@
+# coding: utf-8
+
+"""Keep the clips directory within a disk budget.
+
+A background thread measures clip files, deletes files that don't belong to
+any clip and evicts the least valuable clips when the directory grows over
+its budget or the disk runs low. All work is done in small batches with
+pauses in between, so the video player and the database are never held up
+for long.
+
+Other processes, like the importer, add clips to the database. They are
+picked up into the catalog at each check, and files are checked against the
+database before they are deleted.
+"""
+
+import logging
+import math
+import os
+import shutil
+import time
+
+from threading import Thread
+
+import conversion
+import fingerprint
+import metrics
+from catalog import catalog
+from player.scheduler import scheduler
+from config import db, DATA_DIR, CLIP_STORE_BUDGET, CLIP_STORE_MIN_FREE, \
+    CLIP_STORE_LOW_WATER, CLIP_STORE_PLAY_CREDIT, CLIP_STORE_INTERVAL, \
+    CLIP_STORE_BATCH, CLIP_STORE_ORPHAN_AGE, CLIP_STORE_KEEP_ORIGINALS
+
+logger = logging.getLogger('oxo')
+
+# Seconds to sleep after each batch of files
+PAUSE = 0.1
+
+clips_evicted = metrics.counter("clips_evicted_total",
+    "Clips deleted to stay within the disk budget")
+files_removed = metrics.counter("clip_files_removed_total",
+    "Orphaned files and originals deleted from the clips directory")
+
+
+def value(clip):
+    """Return how much a clip is worth keeping, clips worth less go first.
+
+    This is the time the clip was last played, plus a credit for each
+    doubling of its play count. Clips that were never played are worth the
+    least, older ones first.
+    """
+    return ((clip.get("last_played") or 0)
+        + CLIP_STORE_PLAY_CREDIT * math.log2(1 + (clip.get("play_count") or 0)),
+        clip["id"])
+
+
+class ClipStore(Thread):
+    """Background thread managing the disk usage of clips."""
+
+    def __init__(self, catalog, scheduler, db, clips_dir):
+        """Init as daemon thread."""
+        super(ClipStore, self).__init__(name="store")
+        self.setDaemon(True)
+        self.catalog = catalog
+        self.db = db
+        self.scheduler = scheduler
+        self.clips_dir = clips_dir
+        self.total = 0
+
+    def run(self):
+        """Thread target."""
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                logger.error("Clip store check failed: {}".format(e),
+                    exc_info=True)
+            time.sleep(CLIP_STORE_INTERVAL)
+
+    def step(self):
+        """Measure, clean up and evict clips once."""
+        t0 = time.time()
+        self.refresh()
+        self.measure()
+        names = set(os.listdir(self.clips_dir))
+        if not CLIP_STORE_KEEP_ORIGINALS:
+            self.trim(names)
+        self.sweep(names)
+        self.evict()
+        logger.debug("Clip store checked in {:.2f}s, {} MB used".format(
+            time.time() - t0, self.total // (1024 * 1024)))
+
+    def batches(self, items):
+        """Yield items in batches, pausing in between."""
+        for i in range(0, len(items), CLIP_STORE_BATCH):
+            if i > 0:
+                time.sleep(PAUSE)
+            yield items[i:i + CLIP_STORE_BATCH]
+
+    def used(self, names):
+        """Return those of the file names that clips in the database use."""
+        rv = set()
+        for clip in self.db.clips_with_files(names):
+            rv.add(clip["filename"])
+            rv.add(clip.get("variant"))
+        return rv
+
+    def refresh(self):
+        """Add clips imported by other processes to the catalog."""
+        clips = self.catalog.refresh()
+        for clip in clips:
+            fingerprint.index.add(clip)
+        if len(clips) > 0:
+            logger.info("Found {} new clips in the database".format(len(clips)))
+
+    def measure(self):
+        """Record the disk size of clips that weren't measured yet."""
+        clips = [c for c in self.catalog.all() if c.get("size") is None]
+        for batch in self.batches(clips):
+            for clip in batch:
+                self.catalog.update(clip,
+                    size=conversion.disk_size(*self.catalog.filepaths(clip)))
+        if len(clips) > 0:
+            logger.info("Measured {} clips".format(len(clips)))
+
+    def trim(self, names):
+        """Delete originals of clips that have a variant and a fingerprint.
+
+        Only the variant is played, and the original is not needed to detect
+        reposts once the clip is fingerprinted.
+        """
+        clips = [c for c in self.catalog.all() if c.get("variant")
+            and c.get("fingerprint") and c["filename"] in names]
+        removed = 0
+        for batch in self.batches(clips):
+            needed = self.needed_originals(c["filename"] for c in batch)
+            for clip in batch:
+                if clip["filename"] in needed:
+                    continue
+                conversion.remove(os.path.join(self.clips_dir, clip["filename"]))
+                names.discard(clip["filename"])
+                self.catalog.update(clip,
+                    size=conversion.disk_size(*self.catalog.filepaths(clip)))
+                removed += 1
+        files_removed.inc(removed)
+        if removed > 0:
+            logger.info("Deleted {} transcoded originals".format(removed))
+
+    def needed_originals(self, names):
+        """Return the originals that a clip in the database still needs.
+
+        These are files that are a variant of a clip, or the original of a
+        clip that isn't transcoded or fingerprinted yet.
+        """
+        names = set(names)
+        rv = set()
+        for clip in self.db.clips_with_files(names):
+            if clip.get("variant") in names:
+                rv.add(clip["variant"])
+            if not (clip.get("variant") and clip.get("fingerprint")):
+                rv.add(clip["filename"])
+        return rv
+
+    def sweep(self, names):
+        """Delete old files that don't belong to any clip.
+
+        These are left over by interrupted downloads and transcodes or clips
+        deleted elsewhere. Recent files may still be on their way through
+        the ingest pipeline and are kept.
+        """
+        for clip in self.catalog.all():
+            names.discard(clip["filename"])
+            names.discard(clip.get("variant"))
+
+        removed = 0
+        cutoff = time.time() - CLIP_STORE_ORPHAN_AGE
+        for batch in self.batches(sorted(names)):
+            used = self.used(batch)
+            for name in batch:
+                if name in used:
+                    continue
+                fpath = os.path.join(self.clips_dir, name)
+                try:
+                    if os.path.isfile(fpath) and os.path.getmtime(fpath) < cutoff:
+                        os.remove(fpath)
+                        removed += 1
+                except OSError as e:
+                    logger.warning("Could not delete {}: {}".format(fpath, e))
+        files_removed.inc(removed)
+        if removed > 0:
+            logger.info("Deleted {} orphaned files".format(removed))
+
+    def limit(self):
+        """Return the number of bytes clips may use."""
+        free = shutil.disk_usage(self.clips_dir).free
+        return min(CLIP_STORE_BUDGET, self.total + free - CLIP_STORE_MIN_FREE)
+
+    def evict(self):
+        """Delete the least valuable clips if over the limit.
+
+        Clips are deleted in bulk until usage is down to the low water mark,
+        so this doesn't run again after every new clip. Incoming clips and the
+        clips playing and up next are kept.
+        """
+        clips = self.catalog.all()
+        self.total = sum(c.get("size") or 0 for c in clips)
+        limit = self.limit()
+        if self.total <= limit:
+            return
+
+        keep = set(c["id"] for c in self.scheduler.playing())
+        candidates = sorted((c for c in clips
+            if not c.get("incoming") and c["id"] not in keep), key=value)
+
+        target = limit * CLIP_STORE_LOW_WATER
+        evicted = []
+        freed = 0
+        for clip in candidates:
+            if self.total - freed <= target:
+                break
+            evicted.append(clip)
+            freed += clip.get("size") or 0
+
+        logger.info("Evicting {} clips ({} MB) to stay within {} MB".format(
+            len(evicted), freed // (1024 * 1024), int(limit) // (1024 * 1024)))
+        self.catalog.remove(evicted)
+        for batch in self.batches(evicted):
+            # Keep files shared with clips that weren't evicted
+            used = self.used(name for clip in batch
+                for name in (clip["filename"], clip.get("variant")) if name)
+            for clip in batch:
+                conversion.remove(*(fpath
+                    for fpath in self.catalog.filepaths(clip)
+                    if os.path.basename(fpath) not in used))
+        self.total -= freed
+        clips_evicted.inc(len(evicted))
+
+
+store = ClipStore(catalog, scheduler, db, os.path.join(DATA_DIR, "clips"))
+
+metrics.gauge("clip_store_bytes", "Disk space used by clips",
+    lambda: store.total)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Normalize clips to a profile the Raspberry Pi can decode in hardware.
+
+Every clip is transcoded to H.264 (high profile, level 4.0, yuv420p) scaled
+to fit the display window, without audio and with the index at the start of
+the file. The normalized file is stored next to the original as a variant.
+
+Run this file to normalize all clips in the database that don't have a
+variant yet.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpy
+
+import metrics
+from catalog import catalog
+from config import DATA_DIR, DISPLAY_WIDTH, DISPLAY_HEIGHT, TRANSCODE_WORKERS
+
+logger = logging.getLogger('oxo')
+
+PROFILE = (
+    '-c:v libx264 -profile:v high -level 4.0 -preset veryfast -crf 23 '
+    '-threads 1 -pix_fmt yuv420p -an -movflags +faststart '
+    '-vf "scale=w={w}:h={h}:force_original_aspect_ratio=decrease,'
+    'scale=trunc(iw/2)*2:trunc(ih/2)*2"'
+).format(w=DISPLAY_WIDTH, h=DISPLAY_HEIGHT)
+
+# ffmpeg runs in its own process, so threads are enough to keep one encoder
+# per core busy. Each encoder is limited to a single thread by the profile.
+pool = ThreadPoolExecutor(TRANSCODE_WORKERS)
+
+transcode_seconds = metrics.histogram("transcode_seconds",
+    "Time to transcode a clip to the display profile")
+
+
+def variant_path(fpath):
+    """Return the path of the normalized variant of a clip file."""
+    return "{}.{}x{}.mp4".format(
+        os.path.splitext(fpath)[0], DISPLAY_WIDTH, DISPLAY_HEIGHT)
+
+
+def transcode_file(fpath):
+    """Transcode fpath to the display profile and return the variant path.
+
+    Runs ffmpeg in the calling thread, `normalize` uses the worker pool.
+    """
+    new_fpath = variant_path(fpath)
+    tmp_fpath = new_fpath + ".part.mp4"
+
+    ff = ffmpy.FFmpeg(
+        global_options="-y -loglevel error",
+        inputs={
+            fpath: None
+        },
+        outputs={
+            tmp_fpath: PROFILE
+        }
+    )
+    try:
+        with transcode_seconds.time():
+            ff.run()
+    except Exception:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+    os.replace(tmp_fpath, new_fpath)
+    return new_fpath
+
+
+def normalize(fpath):
+    """Transcode a clip in the worker pool, blocking until it's done."""
+    t0 = time.time()
+    new_fpath = pool.submit(transcode_file, fpath).result()
+    logger.info("Transcoded {} in {:.1f}s".format(
+        os.path.basename(fpath), time.time() - t0))
+    return new_fpath
+
+
+def probe(fpath):
+    """Return duration in seconds and number of frames of a clip.
+
+    Either value is None if ffprobe can't determine it.
+    """
+    ff = ffmpy.FFprobe(
+        global_options="-v error -select_streams v:0 -count_packets "
+            "-show_entries stream=nb_read_packets,duration:format=duration "
+            "-of json",
+        inputs={
+            fpath: None
+        }
+    )
+    out, err = ff.run(stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    data = json.loads(out.decode("utf-8"))
+
+    streams = data.get("streams") or [{}]
+    duration = streams[0].get("duration") or data.get("format", {}).get("duration")
+    frames = streams[0].get("nb_read_packets")
+    return (float(duration) if duration else None,
+        int(frames) if frames else None)
+
+
+def normalize_all():
+    """Transcode all catalog clips that don't have a variant yet."""
+    clips = [c for c in catalog.all() if not c.get("variant")]
+    logger.info("Transcoding {} clips with {} workers...".format(
+        len(clips), TRANSCODE_WORKERS))
+
+    t0 = time.time()
+    futures = {pool.submit(transcode_file,
+        os.path.join(DATA_DIR, "clips", c["filename"])): c for c in clips}
+    for i, future in enumerate(futures):
+        clip = futures[future]
+        try:
+            variant = future.result()
+        except Exception as e:
+            logger.warning("Could not transcode clip {}: {}".format(
+                clip["filename"], e))
+        else:
+            catalog.update(clip, variant=os.path.basename(variant))
+        if (i + 1) % 10 == 0:
+            logger.info("{}/{} clips, {:.2f} clips/s".format(
+                i + 1, len(clips), (i + 1) / (time.time() - t0)))
+    logger.info("Transcoded {} clips in {:.1f}s".format(
+        len(clips), time.time() - t0))
+
+
+if __name__ == '__main__':
+    from config import Config, setup
+    Config().setup_logging()
+    setup()
+    normalize_all()
@@ -0,0 +1,174 @@
+# coding: utf-8
+
+"""Receive Telegram updates on a local HTTP server instead of long polling.
+
+Telegram posts each update as json to a secret path. Updates are put on a
+bounded queue and handed to the handlers of the dispatcher by a single
+worker thread, in the order they arrived. When the queue is full the
+update is refused with 503, so that Telegram sends it again later.
+
+Recorded updates can be replayed for testing with `bench/webhook_replay.py`.
+"""
+
+import hmac
+import json
+import logging
+import signal
+
+from http.server import BaseHTTPRequestHandler
+from queue import Queue, Full
+from threading import Thread, Event
+
+from telegram import Update
+
+import metrics
+from config import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL, \
+    WEBHOOK_QUEUE_SIZE
+
+logger = logging.getLogger('oxo')
+
+# Telegram sends the secret in this header if it was given to setWebhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Updates are small, anything larger than this is not from Telegram
+MAX_BODY = 1024 * 1024
+
+webhook_updates = metrics.counter("webhook_updates_total",
+    "Updates received on the webhook")
+webhook_refused = metrics.counter("webhook_refused_total",
+    "Webhook requests refused because they were invalid or the queue was full")
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accept updates posted to the secret path."""
+
+    def do_POST(self):
+        """Queue a posted update."""
+        receiver = self.server.receiver
+        if not receiver.authorized(self.path, self.headers.get(SECRET_HEADER)):
+            self.refuse(403)
+            return
+
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.refuse(411)
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            self.refuse(400)
+            return
+        if length < 0 or length > MAX_BODY:
+            self.refuse(413)
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            self.refuse(400)
+            return
+        if not isinstance(data, dict):
+            self.refuse(400)
+            return
+
+        if not receiver.put(data):
+            self.refuse(503)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def refuse(self, code):
+        """Answer with an error status."""
+        webhook_refused.inc()
+        self.send_error(code)
+
+    def log_message(self, format, *args):
+        """Log requests at debug level."""
+        logger.debug("Webhook {}: {}".format(
+            self.address_string(), format % args))
+
+
+class Receiver(object):
+    """Webhook server and the worker passing its updates to the dispatcher."""
+
+    def __init__(self, dispatcher, secret, listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT, size=WEBHOOK_QUEUE_SIZE):
+        """Create a receiver for updates posted to /secret."""
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.address = (listen, port)
+        self.queue = Queue(size)
+        self.server = None
+        self.stopped = Event()
+        metrics.gauge("webhook_queue_depth", "Updates waiting to be handled",
+            self.queue.qsize)
+
+    def authorized(self, path, token=None):
+        """Return True if the request carries the secret in path or header."""
+        if token is None:
+            token = path.lstrip("/")
+        return hmac.compare_digest(token.encode("utf-8"),
+            self.secret.encode("utf-8"))
+
+    def put(self, data):
+        """Queue update json without blocking, False if the queue is full."""
+        try:
+            self.queue.put_nowait(data)
+        except Full:
+            logger.warning("Webhook queue full, refusing update {}".format(
+                data.get("update_id")))
+            return False
+        webhook_updates.inc()
+        return True
+
+    def start(self):
+        """Start serving and handling updates."""
+        self.server = metrics.ThreadingHTTPServer(self.address, WebhookHandler)
+        self.server.receiver = self
+        for target, name in ((self.server.serve_forever, "webhook"),
+                (self.work, "webhook-worker")):
+            t = Thread(target=target, name=name)
+            t.setDaemon(True)
+            t.start()
+        logger.info("Receiving updates at http://{}:{}/<secret>".format(
+            *self.server.server_address))
+
+        if WEBHOOK_URL:
+            url = "{}/{}".format(WEBHOOK_URL.rstrip("/"), self.secret)
+            try:
+                self.dispatcher.bot.setWebhook(webhook_url=url)
+            except Exception as e:
+                logger.error("Could not register webhook: {}".format(e))
+            else:
+                logger.info("Registered webhook at {}/<secret>".format(
+                    WEBHOOK_URL.rstrip("/")))
+
+    def work(self):
+        """Pass queued updates to the dispatcher, one at a time."""
+        while True:
+            data = self.queue.get()
+            try:
+                update = Update.de_json(data, self.dispatcher.bot)
+                self.dispatcher.process_update(update)
+            except Exception as e:
+                logger.error("Could not handle update {}: {}".format(
+                    data.get("update_id"), e), exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    def stop(self):
+        """Stop accepting updates."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+    def idle(self, stop_signals=(signal.SIGINT, signal.SIGTERM, signal.SIGABRT)):
+        """Block until one of the signals is received, then stop."""
+        for sig in stop_signals:
+            signal.signal(sig, lambda signum, frame: self.stopped.set())
+        while not self.stopped.wait(1):
+            pass
+        self.stop()
+